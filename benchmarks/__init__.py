@@ -0,0 +1,33 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Benchmarks for *photofs*.
+
+Run ``python -m benchmarks.generate --help`` to create a synthetic *Shotwell*
+library, and ``python -m benchmarks --help`` to run the benchmarks against it.
+"""
+
+import os
+import sys
+
+
+# Make the photofs package importable when run from a source checkout
+LIB_DIR = os.path.join(
+    os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+    'lib')
+if LIB_DIR not in sys.path:
+    sys.path.insert(0, LIB_DIR)
@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Runs benchmarks against a *Shotwell* library without mounting it.
+
+The file system operations are invoked directly on a :class:`photofs.PhotoFS`
+instance, so the results do not include the overhead of *FUSE* and the
+kernel.
+"""
+
+import gc
+import os
+import sys
+import time
+import tracemalloc
+
+from ._fs import FileInfo, add_options_argument, make_fs, walk
+
+from photofs import ImageSource
+
+
+#: The registered benchmarks, as a list of ``(name, function)`` tuples
+BENCHMARKS = []
+
+#: The size of read requests; this is the default maximum read size of FUSE
+READ_SIZE = 128 * 1024
+
+
+def benchmark(name):
+    """A decorator to register a benchmark.
+
+    The decorated function is called with the parsed command line arguments
+    to prepare the benchmark, and must return a callable running it. This
+    callable must return a tuple ``(operations, size)``, where ``size`` is the
+    number of bytes transferred, or ``None``. Only the callable is timed.
+
+    :param str name: The name of the benchmark.
+    """
+    def inner(function):
+        BENCHMARKS.append((name, function))
+        return function
+
+    return inner
+
+
+def count(tag):
+    """Counts the distinct images in a tag and its descendants.
+
+    :param dict tag: The tag.
+
+    :return: the number of images
+    :rtype: int
+    """
+    images = set()
+    remaining = [tag]
+    while remaining:
+        for item in remaining.pop().values():
+            if isinstance(item, dict):
+                remaining.append(item)
+            else:
+                images.add(id(item))
+
+    return len(images)
+
+
+@benchmark('load')
+def load(args):
+    """Loads all tags and images from the database."""
+    source = ImageSource.get('shotwell')(database=args.database)
+
+    def inner():
+        source.refresh()
+        return count(source.root), None
+
+    return inner
+
+
+def presentations(name):
+    """Registers a benchmark for both the filtered and the flat presentation.
+
+    The decorated function is called with the parsed command line arguments,
+    a loaded file system and the result of :func:`walk` for it. Loading and
+    walking the file system is not timed.
+
+    :param str name: The name of the benchmark.
+    """
+    def inner(function):
+        for flat in (False, True):
+            def prepare(args, flat=flat):
+                photo_fs = make_fs(args.database, flat, **args.options)
+                paths = walk(photo_fs)
+                return lambda: function(args, photo_fs, *paths)
+            benchmark('%s (%s)' % (
+                name,
+                'flat' if flat else 'filtered'))(prepare)
+
+        return function
+
+    return inner
+
+
+@presentations('readdir')
+def readdir(args, photo_fs, directories, files):
+    """Lists all directories.
+
+    The filter indices have already been populated by :func:`walk`.
+    """
+    for _ in range(args.rounds):
+        for path in directories:
+            for _ in photo_fs.readdir(path, 0):
+                pass
+    return args.rounds * len(directories), None
+
+
+@presentations('getattr')
+def bench_getattr(args, photo_fs, directories, files):
+    """Reads the attributes of all directories and files."""
+    paths = directories + files
+    for _ in range(args.rounds):
+        for path in paths:
+            photo_fs.getattr(path)
+    return args.rounds * len(paths), None
+
+
+@presentations('read')
+def read(args, photo_fs, directories, files):
+    """Opens, reads completely and closes files."""
+    operations = 0
+    size = 0
+    for path in files[:args.read_files]:
+        fi = FileInfo() if photo_fs.raw_fi else None
+        fh = photo_fs.open(path, fi or os.O_RDONLY)
+        if fi is not None:
+            fh = fi
+        try:
+            offset = 0
+            while True:
+                data = photo_fs.read(path, READ_SIZE, offset, fh)
+                operations += 1
+                if not data:
+                    break
+                offset += len(data)
+        finally:
+            photo_fs.release(path, fh)
+        size += offset
+
+    return operations, size
+
+
+def run(name, function, args):
+    """Runs a single benchmark and prints the result.
+
+    The peak memory includes the preparation of the benchmark, so it is the
+    memory required to load the library and then run the benchmark.
+
+    :param str name: The name of the benchmark.
+
+    :param function: The benchmark function.
+
+    :param args: The parsed command line arguments.
+    """
+    gc.collect()
+    if args.memory:
+        tracemalloc.start()
+    try:
+        inner = function(args)
+        start = time.time()
+        operations, size = inner()
+        duration = time.time() - start
+        peak = tracemalloc.get_traced_memory()[1] if args.memory else None
+    finally:
+        if args.memory:
+            tracemalloc.stop()
+
+    sys.stdout.write('%-20s %12d %10.3f %14.1f %10s %10s\n' % (
+        name,
+        operations,
+        duration,
+        operations / duration if duration else float('inf'),
+        '%.1f' % (peak / 1024.0 / 1024.0) if peak is not None else '-',
+        '%.1f' % (size / 1024.0 / 1024.0 / duration)
+        if size is not None and duration else '-'))
+    sys.stdout.flush()
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks',
+        description='Benchmark photofs against a Shotwell library. Use '
+        '"python -m benchmarks.generate" to create a synthetic library.')
+
+    parser.add_argument(
+        'database',
+        help='The Shotwell database.')
+
+    parser.add_argument(
+        'benchmarks',
+        help='The benchmarks to run; the default is to run all. Available '
+        'benchmarks are: %s.' % ', '.join(
+            '"%s"' % name for name, _ in BENCHMARKS),
+        nargs='*')
+
+    parser.add_argument(
+        '--rounds',
+        help='The number of times to repeat the readdir and getattr '
+        'benchmarks.',
+        type=int,
+        default=1)
+
+    parser.add_argument(
+        '--read-files',
+        help='The number of files to read in the read benchmarks.',
+        type=int,
+        default=100)
+
+    parser.add_argument(
+        '--no-memory',
+        help='Do not trace memory allocations. Tracing makes the benchmarks '
+        'considerably slower.',
+        dest='memory',
+        action='store_false')
+
+    add_options_argument(parser)
+
+    args = parser.parse_args()
+
+    sys.stdout.write('%-20s %12s %10s %14s %10s %10s\n' % (
+        'benchmark', 'operations', 'time (s)', 'operations/s', 'peak (MiB)',
+        'MiB/s'))
+    for name, function in BENCHMARKS:
+        if not args.benchmarks or name in args.benchmarks \
+                or name.split(' ')[0] in args.benchmarks:
+            run(name, function, args)
+
+
+if __name__ == '__main__':
+    main()
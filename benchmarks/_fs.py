@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import argparse
+import ast
+import os
+
+from . import LIB_DIR  # noqa: F401; makes photofs importable
+
+from photofs import Image, PhotoFS
+
+
+#: The filters used for the filtered presentation; these are the defaults of
+#: the command line interface
+FILTERS = {
+    'Photos': lambda i:
+        not i.is_video if isinstance(i, Image) else not i.has_video,
+    'Videos': lambda i:
+        i.is_video if isinstance(i, Image) else i.has_video}
+
+
+class FileInfo(object):
+    """The attributes of ``fuse_file_info`` used by the file system.
+
+    An instance is passed instead of the open flags when the file system
+    requires the raw file info structure.
+    """
+    flags = os.O_RDONLY
+    fh = 0
+    direct_io = False
+    keep_cache = False
+
+
+def make_fs(database, flat, **kwargs):
+    """Creates a file system for a library and loads it.
+
+    :param str database: The *Shotwell* database.
+
+    :param bool flat: Whether to use the flat presentation.
+
+    :param kwargs: Keyword arguments passed to :class:`photofs.PhotoFS`.
+
+    :return: a file system
+    :rtype: photofs.PhotoFS
+    """
+    photo_fs = PhotoFS(
+        os.path.dirname(os.path.abspath(database)),
+        source='shotwell',
+        database=database,
+        filters=None if flat else dict(FILTERS),
+        **kwargs)
+    photo_fs.image_source.root
+    return photo_fs
+
+
+def walk(photo_fs):
+    """Lists all paths of a file system.
+
+    :param photo_fs.PhotoFS photo_fs: The file system.
+
+    :return: the tuple ``(directories, files)``
+    """
+    directories = []
+    files = []
+    remaining = [os.path.sep]
+    while remaining:
+        path = remaining.pop()
+        directories.append(path)
+        for name, _, _ in photo_fs.readdir(path, 0):
+            child = os.path.join(path, name)
+            if isinstance(photo_fs.locate(child)[1], dict):
+                remaining.append(child)
+            else:
+                files.append(child)
+
+    return directories, files
+
+
+def add_options_argument(parser):
+    """Adds the command line argument ``--option NAME=VALUE``, which collects
+    keyword arguments for :class:`photofs.PhotoFS` in ``options``.
+
+    :param argparse.ArgumentParser parser: The argument parser.
+    """
+    class OptionAction(argparse.Action):
+        def __call__(self, parser, namespace, values, option_string):
+            name, value = values[0].split('=', 1)
+            try:
+                value = ast.literal_eval(value)
+            except (SyntaxError, ValueError):
+                pass
+            namespace.options[name.replace('-', '_')] = value
+    parser.add_argument(
+        '--option', '-o',
+        help='A keyword argument, NAME=VALUE, passed to the file system, '
+        'for example "-o path_cache_size=0".',
+        nargs=1,
+        action=OptionAction)
+    parser.set_defaults(options={})
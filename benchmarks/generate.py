@@ -0,0 +1,325 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Generates a synthetic *Shotwell* library.
+
+The library consists of a ``photo.db`` database with the tables read by
+*photofs*, and dummy files for all photos and videos. The files are sparse, so
+even libraries with millions of images use little disk space, but every file
+is a distinct directory entry, so loading a library performs as many ``lstat``
+calls as a real one.
+"""
+
+import os
+import random
+import sqlite3
+import time
+
+
+#: The tables created; the columns are a subset of those used by *Shotwell*
+SCHEMA = (
+    """
+    CREATE TABLE PhotoTable (
+        id INTEGER PRIMARY KEY,
+        filename TEXT UNIQUE NOT NULL,
+        width INTEGER,
+        height INTEGER,
+        filesize INTEGER,
+        timestamp INTEGER,
+        exposure_time INTEGER,
+        orientation INTEGER,
+        import_id INTEGER,
+        event_id INTEGER,
+        md5 TEXT,
+        time_created INTEGER,
+        flags INTEGER DEFAULT 0,
+        rating INTEGER DEFAULT 0,
+        file_format INTEGER DEFAULT 0,
+        title TEXT,
+        comment TEXT)""",
+    """
+    CREATE TABLE VideoTable (
+        id INTEGER PRIMARY KEY,
+        filename TEXT UNIQUE NOT NULL,
+        width INTEGER,
+        height INTEGER,
+        clip_duration REAL,
+        is_interpretable INTEGER,
+        filesize INTEGER,
+        timestamp INTEGER,
+        exposure_time INTEGER,
+        import_id INTEGER,
+        event_id INTEGER,
+        md5 TEXT,
+        time_created INTEGER,
+        rating INTEGER DEFAULT 0,
+        title TEXT,
+        flags INTEGER DEFAULT 0,
+        comment TEXT)""",
+    """
+    CREATE TABLE TagTable (
+        id INTEGER PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL,
+        photo_id_list TEXT,
+        time_created INTEGER)""")
+
+#: The top level tag categories and the names used for their descendants
+CATEGORIES = {
+    'Places': ('Sweden', 'Norway', 'Italy', 'Japan', 'Canada', 'Chile'),
+    'People': ('Alice', 'Bob', 'Carol', 'Dave', 'Eve', 'Frank', 'Grace'),
+    'Events': ('Birthday', 'Wedding', 'Holiday', 'Graduation', 'Party'),
+    'Things': ('Cars', 'Boats', 'Food', 'Flowers', 'Cats', 'Dogs')}
+
+#: The extensions of generated photos and videos
+PHOTO_EXTENSIONS = ('jpg', 'jpg', 'jpg', 'png', 'cr2', 'nef')
+VIDEO_EXTENSIONS = ('mp4', 'mov', 'avi')
+
+
+def make_tag_names(count, depth, rng):
+    """Generates tag names.
+
+    Most names are hierarchical, like ``/Places/Sweden/Stockholm 3``, but some
+    are flat, like *Shotwell* tags created before hierarchical tags were
+    supported.
+
+    :param int count: The number of tags.
+
+    :param int depth: The maximum depth of hierarchical tags.
+
+    :param random.Random rng: The random number generator.
+
+    :return: the tag names, including all ancestors of hierarchical tags
+    :rtype: [str]
+    """
+    names = set()
+    while len(names) < count:
+        if rng.random() < 0.1:
+            names.add('Album %d' % rng.randrange(count))
+            continue
+
+        category = rng.choice(sorted(CATEGORIES))
+        segments = [category]
+        for level in range(rng.randrange(1, depth)):
+            segments.append('%s %d' % (
+                rng.choice(CATEGORIES[category]),
+                rng.randrange(1 + count // 10)))
+
+        # Shotwell stores all ancestors of a hierarchical tag as tags
+        for i in range(1, len(segments) + 1):
+            names.add('/' + '/'.join(segments[:i]))
+
+    return sorted(names)[:count]
+
+
+def generate(
+        directory,
+        photos=10000,
+        videos=500,
+        tags=200,
+        depth=4,
+        tags_per_image=2,
+        burst=5,
+        file_size=4 * 1024 * 1024,
+        seed=0):
+    """Generates a synthetic *Shotwell* library.
+
+    :param str directory: The directory in which to create the library. The
+        database is created as ``photo.db``, and the files in the
+        subdirectory ``files``.
+
+    :param int photos: The number of photos.
+
+    :param int videos: The number of videos.
+
+    :param int tags: The number of tags.
+
+    :param int depth: The maximum depth of hierarchical tags.
+
+    :param int tags_per_image: The average number of tags applied to every
+        image.
+
+    :param int burst: The average number of photos taken within the same
+        minute; such photos are untitled, so they get the same file name
+        before being made unique.
+
+    :param int file_size: The apparent size of every file, in bytes.
+
+    :param int seed: The random seed.
+
+    :return: the location of the database
+    :rtype: str
+    """
+    rng = random.Random(seed)
+    database = os.path.join(directory, 'photo.db')
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    if os.path.exists(database):
+        os.unlink(database)
+
+    db = sqlite3.connect(database)
+    try:
+        for statement in SCHEMA:
+            db.execute(statement)
+
+        # Generate the images, starting ten years ago and moving forward in
+        # bursts
+        timestamp = int(time.time()) - 10 * 365 * 24 * 60 * 60
+        ids = []
+        for table, count, extensions, header, prefix in (
+                ('PhotoTable', photos, PHOTO_EXTENSIONS, 'thumb', 'IMG'),
+                ('VideoTable', videos, VIDEO_EXTENSIONS, 'video-', 'VID')):
+            rows = []
+            for r_id in range(1, count + 1):
+                if rng.random() < 1.0 / max(1, burst):
+                    timestamp += rng.randrange(60, 3 * 24 * 60 * 60)
+                t = time.localtime(timestamp)
+                filename = os.path.join(
+                    directory,
+                    'files',
+                    '%04d' % t.tm_year,
+                    '%02d' % t.tm_mon,
+                    '%02d' % t.tm_mday,
+                    '%s_%07d.%s' % (prefix, r_id, rng.choice(extensions)))
+                make_file(filename, file_size)
+                rows.append((
+                    r_id,
+                    filename,
+                    file_size,
+                    timestamp,
+                    timestamp + rng.randrange(60),
+                    'Photo %d' % r_id if rng.random() < 0.05 else None))
+                ids.append('%s%016x' % (header, r_id))
+
+            db.executemany(
+                """
+                INSERT INTO %s (
+                    id, filename, filesize, timestamp, exposure_time, title)
+                VALUES (?, ?, ?, ?, ?, ?)""" % table,
+                rows)
+
+        # Apply tags to the images; an image tagged with a hierarchical tag
+        # is also listed in all its ancestors, just like in Shotwell
+        names = make_tag_names(tags, depth, rng)
+        members = dict((name, []) for name in names)
+        for i in ids:
+            for _ in range(rng.randrange(2 * tags_per_image + 1)):
+                name = rng.choice(names)
+                while name:
+                    members[name].append(i)
+                    name = name.rsplit('/', 1)[0] if name[0] == '/' else ''
+
+        db.executemany(
+            """
+            INSERT INTO TagTable (name, photo_id_list, time_created)
+            VALUES (?, ?, ?)""",
+            (
+                (
+                    name,
+                    ''.join(i + ',' for i in sorted(set(members[name]))),
+                    timestamp)
+                for name in names))
+
+        db.commit()
+
+    finally:
+        db.close()
+
+    return database
+
+
+def make_file(filename, size):
+    """Creates a sparse file.
+
+    :param str filename: The file to create. Its directory is created if it
+        does not exist.
+
+    :param int size: The apparent size of the file.
+    """
+    try:
+        f = open(filename, 'wb')
+    except (IOError, OSError):
+        os.makedirs(os.path.dirname(filename))
+        f = open(filename, 'wb')
+    with f:
+        f.truncate(size)
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.generate',
+        description='Generate a synthetic Shotwell library.')
+
+    parser.add_argument(
+        'directory',
+        help='The directory in which to create the library.')
+
+    parser.add_argument(
+        '--photos',
+        help='The number of photos.',
+        type=int,
+        default=10000)
+
+    parser.add_argument(
+        '--videos',
+        help='The number of videos.',
+        type=int,
+        default=500)
+
+    parser.add_argument(
+        '--tags',
+        help='The number of tags.',
+        type=int,
+        default=200)
+
+    parser.add_argument(
+        '--depth',
+        help='The maximum depth of hierarchical tags.',
+        type=int,
+        default=4)
+
+    parser.add_argument(
+        '--tags-per-image',
+        help='The average number of tags applied to every image.',
+        type=int,
+        default=2)
+
+    parser.add_argument(
+        '--burst',
+        help='The average number of photos taken within the same minute.',
+        type=int,
+        default=5)
+
+    parser.add_argument(
+        '--file-size',
+        help='The apparent size of every file, in bytes.',
+        type=int,
+        default=4 * 1024 * 1024)
+
+    parser.add_argument(
+        '--seed',
+        help='The random seed.',
+        type=int,
+        default=0)
+
+    args = parser.parse_args()
+    print(generate(**vars(args)))
+
+
+if __name__ == '__main__':
+    main()
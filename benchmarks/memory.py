@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Measures the memory used by the in-memory representation of images.
+
+Images are created the way the *Shotwell* image source creates them, and the
+memory allocated for them is traced. The locations and titles are created
+beforehand, since they are the same strings that are read from the database,
+so only the memory used by the image objects themselves is counted.
+"""
+
+import gc
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+from . import LIB_DIR  # noqa: F401; makes photofs importable
+
+from photofs._image import FileBasedImage
+
+
+def measure(count):
+    """Creates images and measures the memory they use.
+
+    :param int count: The number of images to create.
+
+    :return: the tuple ``(size, duration)``, where ``size`` is the number of
+        bytes allocated for all images and ``duration`` the number of seconds
+        spent creating them
+    """
+    with tempfile.NamedTemporaryFile(suffix='.jpg') as f:
+        st = os.lstat(f.name)
+        rows = [
+            (
+                'Title %d' % i if i % 3 == 0 else None,
+                '%s/%d.jpg' % (os.path.dirname(f.name), i),
+                1400000000 + i)
+            for i in range(count)]
+
+        gc.collect()
+        tracemalloc.start()
+        try:
+            before = tracemalloc.get_traced_memory()[0]
+            start = time.time()
+            images = [
+                FileBasedImage(title, location, timestamp, False, st)
+                for title, location, timestamp in rows]
+            duration = time.time() - start
+            size = tracemalloc.get_traced_memory()[0] - before
+        finally:
+            tracemalloc.stop()
+
+    del images
+    return size, duration
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.memory',
+        description='Measure the memory used by images.')
+
+    parser.add_argument(
+        '--images',
+        help='The number of images to create.',
+        type=int,
+        default=100000)
+
+    args = parser.parse_args()
+
+    size, duration = measure(args.images)
+    sys.stdout.write(
+        '%d images: %.0f bytes per image, %.1f MiB per million images, '
+        'created in %.3f s\n' % (
+            args.images,
+            size / float(args.images),
+            size / float(args.images) * 1000000 / 1024.0 / 1024.0,
+            duration))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Verifies that incremental refreshes produce the same tree as loading the
+database from scratch.
+
+A generated library is modified repeatedly: tags are retagged, emptied,
+added and removed, and images are retitled and removed. After every
+modification, the tree updated by an incremental refresh is compared with the
+tree of a newly created image source.
+"""
+
+import os
+import random
+import sqlite3
+import sys
+
+from . import LIB_DIR  # noqa: F401; makes photofs importable
+from .generate import generate
+
+from photofs import ImageSource, Tag
+
+
+def describe(tree):
+    """Describes a tree.
+
+    :param Tree tree: The tree.
+
+    :return: a mapping from the path of every item to ``None`` for tags and
+        the location for images
+    :rtype: dict
+    """
+    result = {}
+    remaining = [('', tree)]
+    while remaining:
+        prefix, tag = remaining.pop()
+        for name, item in tag.items():
+            path = prefix + os.path.sep + name
+            if isinstance(item, Tag):
+                result[path] = None
+                remaining.append((path, item))
+            else:
+                result[path] = item.location
+
+    return result
+
+
+class Modifier(object):
+    """Makes random modifications to a library.
+    """
+    def __init__(self, database, seed):
+        self.database = database
+        self._rng = random.Random(seed)
+
+    def __call__(self):
+        """Modifies the library once.
+        """
+        rng = self._rng
+        db = sqlite3.connect(self.database)
+        try:
+            ids = [
+                '%s%016x' % (prefix, r[0])
+                for prefix, table in (
+                    ('thumb', 'PhotoTable'), ('video-', 'VideoTable'))
+                for r in db.execute('SELECT id FROM %s' % table)]
+            tags = list(db.execute('SELECT id, name FROM TagTable'))
+
+            # Retag, and sometimes empty, some tags
+            for r_id, _ in rng.sample(tags, max(1, len(tags) // 10)):
+                db.execute(
+                    'UPDATE TagTable SET photo_id_list = ? WHERE id = ?',
+                    (
+                        ''.join(
+                            i + ','
+                            for i in rng.sample(
+                                ids,
+                                rng.randrange(len(ids) // 20)))
+                        if rng.random() < 0.8 else rng.choice(('', None)),
+                        r_id))
+
+            # Add tags beneath existing ones, and remove some
+            for _, name in rng.sample(tags, 2):
+                db.execute(
+                    'INSERT OR IGNORE INTO TagTable (name, photo_id_list) '
+                    'VALUES (?, ?)',
+                    (
+                        '%s/Added %d' % (
+                            name if name[0] == '/' else '/' + name,
+                            rng.randrange(1000)),
+                        ''.join(i + ',' for i in rng.sample(ids, 5))))
+            db.execute(
+                'DELETE FROM TagTable WHERE id = ?',
+                (rng.choice(tags)[0],))
+
+            # Retitle and remove some images
+            for table in ('PhotoTable', 'VideoTable'):
+                rows = [r[0] for r in db.execute('SELECT id FROM %s' % table)]
+                for r_id in rng.sample(rows, max(1, len(rows) // 20)):
+                    db.execute(
+                        'UPDATE %s SET title = ? WHERE id = ?' % table,
+                        (rng.choice((None, 'Title', 'Photo %d' % r_id)), r_id))
+                db.execute(
+                    'DELETE FROM %s WHERE id = ?' % table,
+                    (rng.choice(rows),))
+
+            db.commit()
+
+        finally:
+            db.close()
+
+        # Make sure that the modification time changes
+        st = os.stat(self.database)
+        os.utime(
+            self.database,
+            ns=(st.st_atime_ns, st.st_mtime_ns + 1000000))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.refresh',
+        description='Verify that incremental refreshes produce the same tree '
+        'as a full load.')
+
+    parser.add_argument(
+        'directory',
+        help='The directory in which to generate a library.')
+
+    parser.add_argument(
+        '--photos',
+        help='The number of photos.',
+        type=int,
+        default=1000)
+
+    parser.add_argument(
+        '--iterations',
+        help='The number of modifications.',
+        type=int,
+        default=20)
+
+    parser.add_argument(
+        '--seed',
+        help='The random seed.',
+        type=int,
+        default=0)
+
+    args = parser.parse_args()
+
+    database = generate(
+        args.directory,
+        photos=args.photos,
+        videos=args.photos // 20,
+        tags=max(20, args.photos // 20),
+        file_size=0,
+        seed=args.seed)
+    source = ImageSource.get('shotwell')(
+        database=database,
+        incremental_refresh=True)
+    source.root
+    modify = Modifier(database, args.seed)
+
+    failures = 0
+    for iteration in range(args.iterations):
+        modify()
+        source.refresh()
+        actual = describe(source.root)
+        expected = describe(
+            ImageSource.get('shotwell')(database=database).root)
+        if actual != expected:
+            failures += 1
+            differences = sorted(
+                path
+                for path in set(actual) | set(expected)
+                if actual.get(path, False) != expected.get(path, False))
+            sys.stdout.write('FAILED iteration %d: %d paths differ\n' % (
+                iteration, len(differences)))
+            for path in differences[:10]:
+                sys.stdout.write('    %s: %r, expected %r\n' % (
+                    path,
+                    actual.get(path, 'missing'),
+                    expected.get(path, 'missing')))
+
+    sys.stdout.write('%d iterations, %d failures\n' % (
+        args.iterations, failures))
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
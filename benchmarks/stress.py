@@ -0,0 +1,327 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+"""Hammers all file system operations from many threads while the database is
+modified and refreshed repeatedly.
+
+The tags beneath the root tag ``Events`` are rewritten continuously, so paths
+beneath them may appear and disappear. All other paths are stable, so any
+error or changed result for them indicates a concurrency problem, as does any
+error other than ``ENOENT`` for the volatile paths.
+"""
+
+import collections
+import errno
+import os
+import random
+import sqlite3
+import sys
+import threading
+import time
+
+from ._fs import FileInfo, add_options_argument, make_fs, walk
+from .generate import generate
+
+import fuse
+
+
+#: The root tag whose descendants are modified
+VOLATILE = 'Events'
+
+#: The number of bytes read from every opened file
+READ_SIZE = 64 * 1024
+
+
+def is_volatile(path):
+    """Returns whether a path may change between refreshes.
+
+    :param str path: The path.
+
+    :return: whether ``path`` is beneath the modified root tag
+    :rtype: bool
+    """
+    return VOLATILE in path.split(os.path.sep)
+
+
+class Writer(threading.Thread):
+    """Rewrites the tags beneath :attr:`VOLATILE` until stopped.
+    """
+    def __init__(self, database, interval, seed):
+        super(Writer, self).__init__(name='stress-writer')
+        self.daemon = True
+        self.database = database
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.writes = 0
+        self._rng = random.Random(seed)
+
+    def run(self):
+        db = sqlite3.connect(self.database)
+        try:
+            ids = [
+                '%s%016x' % (prefix, r[0])
+                for prefix, table in (
+                    ('thumb', 'PhotoTable'), ('video-', 'VideoTable'))
+                for r in db.execute('SELECT id FROM %s' % table)]
+            tags = [
+                r[0]
+                for r in db.execute(
+                    'SELECT id FROM TagTable WHERE name = ? OR name LIKE ?',
+                    ('/' + VOLATILE, '/' + VOLATILE + '/%'))]
+
+            while not self.stopped.wait(self.interval):
+                db.executemany(
+                    'UPDATE TagTable SET photo_id_list = ? WHERE id = ?',
+                    (
+                        (
+                            ''.join(
+                                i + ','
+                                for i in self._rng.sample(
+                                    ids,
+                                    self._rng.randrange(1, len(ids) // 10))),
+                            tag)
+                        for tag in tags))
+                db.commit()
+
+                # Make sure that the modification time changes
+                st = os.stat(self.database)
+                os.utime(
+                    self.database,
+                    ns=(st.st_atime_ns, st.st_mtime_ns + 1000000))
+                self.writes += 1
+
+        finally:
+            db.close()
+
+
+class Reader(threading.Thread):
+    """Invokes random operations until stopped, and verifies the results for
+    stable paths.
+    """
+    def __init__(self, photo_fs, expected, seed):
+        """Creates a reader.
+
+        :param photofs.PhotoFS photo_fs: The file system.
+
+        :param expected: The expected results. This is a tuple ``(listings,
+            sizes)``, mapping directories to the set of names they contain and
+            files to their sizes.
+
+        :param int seed: The random seed.
+        """
+        super(Reader, self).__init__()
+        self.daemon = True
+        self.photo_fs = photo_fs
+        self.listings, self.sizes = expected
+        self.stopped = threading.Event()
+        self.operations = collections.Counter()
+        self.failures = []
+        self._rng = random.Random(seed)
+        self._directories = list(self.listings)
+        self._files = list(self.sizes)
+
+    def run(self):
+        operations = (
+            self.readdir,
+            self.getattr,
+            self.read)
+        while not self.stopped.is_set():
+            operation = self._rng.choice(operations)
+            paths = self._directories if operation == self.readdir \
+                else self._files
+            path = self._rng.choice(paths)
+            try:
+                result = operation(path)
+                if not is_volatile(path) and result is not None:
+                    self.failures.append((operation.__name__, path, result))
+            except fuse.FuseOSError as e:
+                if not is_volatile(path) or e.errno != errno.ENOENT:
+                    self.failures.append((operation.__name__, path, e))
+            except Exception as e:
+                self.failures.append((operation.__name__, path, e))
+            self.operations[operation.__name__] += 1
+
+    def readdir(self, path):
+        """Lists a directory.
+
+        :return: a description of the difference from the expected listing,
+            or ``None``
+        """
+        names = set(
+            name
+            for name, _, _ in self.photo_fs('readdir', path, 0)) \
+            - set((VOLATILE,))
+        expected = self.listings[path]
+        if names != expected:
+            return 'missing %s, unexpected %s' % (
+                sorted(expected - names)[:5], sorted(names - expected)[:5])
+
+    def getattr(self, path):
+        """Reads the attributes of a file.
+
+        :return: a description of the difference from the expected size, or
+            ``None``
+        """
+        st_size = self.photo_fs('getattr', path)['st_size']
+        if st_size != self.sizes[path]:
+            return 'size %d, expected %d' % (st_size, self.sizes[path])
+
+    def read(self, path):
+        """Opens a file, reads from it and closes it.
+
+        :return: a description of the difference from the expected size, or
+            ``None``
+        """
+        fi = FileInfo() if self.photo_fs.raw_fi else None
+        fh = self.photo_fs('open', path, fi or os.O_RDONLY)
+        if fi is not None:
+            fh = fi
+        try:
+            data = self.photo_fs('read', path, READ_SIZE, 0, fh)
+        finally:
+            self.photo_fs('release', path, fh)
+        expected = min(READ_SIZE, self.sizes[path])
+        if len(data) != expected:
+            return 'read %d bytes, expected %d' % (len(data), expected)
+
+
+def expectations(photo_fs):
+    """Lists the expected results for all paths of a file system.
+
+    :param photofs.PhotoFS photo_fs: The file system.
+
+    :return: a tuple ``(listings, sizes)`` for use by :class:`Reader`
+    """
+    directories, files = walk(photo_fs)
+    return (
+        dict(
+            (
+                path,
+                set(name for name, _, _ in photo_fs.readdir(path, 0)) -
+                set((VOLATILE,)))
+            for path in directories),
+        dict(
+            (path, photo_fs.getattr(path)['st_size'])
+            for path in files))
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        prog='python -m benchmarks.stress',
+        description='Hammer photofs from many threads while the database is '
+        'modified.')
+
+    parser.add_argument(
+        'directory',
+        help='The directory in which to generate a library.')
+
+    parser.add_argument(
+        '--photos',
+        help='The number of photos.',
+        type=int,
+        default=2000)
+
+    parser.add_argument(
+        '--threads',
+        help='The number of reading threads.',
+        type=int,
+        default=16)
+
+    parser.add_argument(
+        '--duration',
+        help='The number of seconds to run.',
+        type=float,
+        default=10.0)
+
+    parser.add_argument(
+        '--write-interval',
+        help='The number of seconds between modifications of the database.',
+        type=float,
+        default=0.05)
+
+    parser.add_argument(
+        '--flat',
+        help='Use the flat presentation.',
+        action='store_true')
+
+    parser.add_argument(
+        '--seed',
+        help='The random seed.',
+        type=int,
+        default=0)
+
+    add_options_argument(parser)
+
+    args = parser.parse_args()
+
+    database = generate(
+        args.directory,
+        photos=args.photos,
+        videos=args.photos // 20,
+        tags=max(20, args.photos // 50),
+        file_size=READ_SIZE // 2,
+        seed=args.seed)
+    options = dict(refresh_interval=args.write_interval / 2)
+    options.update(args.options)
+    photo_fs = make_fs(database, args.flat, **options)
+    expected = expectations(photo_fs)
+
+    photo_fs.init(os.path.sep)
+    writer = Writer(database, args.write_interval, args.seed)
+    readers = [
+        Reader(photo_fs, expected, args.seed + i)
+        for i in range(args.threads)]
+    try:
+        writer.start()
+        for reader in readers:
+            reader.start()
+        time.sleep(args.duration)
+
+    finally:
+        for reader in readers:
+            reader.stopped.set()
+        writer.stopped.set()
+        for reader in readers:
+            reader.join()
+        writer.join()
+        photo_fs.destroy(os.path.sep)
+
+    operations = sum(
+        (reader.operations for reader in readers),
+        collections.Counter())
+    failures = [
+        failure
+        for reader in readers
+        for failure in reader.failures]
+    sys.stdout.write(
+        '%d writes, %d refreshes, %s\n' % (
+            writer.writes,
+            photo_fs.image_source.refreshes,
+            ', '.join(
+                '%d %s' % (count, name)
+                for name, count in sorted(operations.items()))))
+    for name, path, failure in failures[:20]:
+        sys.stdout.write('FAILED %s(%r): %r\n' % (name, path, failure))
+    sys.stdout.write('%d failures\n' % len(failures))
+
+    return 1 if failures else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
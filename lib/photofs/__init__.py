@@ -16,18 +16,30 @@
 # You should have received a copy of the GNU General Public License along with
 # this program. If not, see <http://www.gnu.org/licenses/>.
 
+import logging
 import os
+import signal
 import stat
 import threading
 import time
+import types
 
 # For FUSE
 import errno
 import fuse
 
+from xdg.BaseDirectory import xdg_cache_home
+
+from ._cache import AttributeCache, CachePolicy, DirectoryWatcher, PathCache
+from ._handle import DescriptorPool, ReadAhead
 from ._image import Image, FileBasedImage
-from ._source import ImageSource
+from ._index import Cursor, FilterIndex
+from ._metrics import Metrics, MetricsFile
+from ._preview import Preview, PreviewCache, PreviewFilter, preview_name
+from ._source import ImageSource, Tree
 from ._tag import Tag
+from ._timeline import Period, Timeline
+from ._trace import SamplingProfiler, Tracer, phase
 
 
 # Import the actual image sources
@@ -40,6 +52,14 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
     It presents the tagged image libraries from image sources as a tag tree in
     the file system.
 
+    Operations are invoked concurrently by *FUSE*. Every operation reads the
+    tree published by the image source once, and resolves all paths in that
+    tree; since published trees are never modified, operations need no locks
+    to read them, and a refresh never blocks or disturbs them. Everything
+    derived from a tree, such as filter indices and resolved paths, is keyed
+    by the generation of the tree. The remaining shared state, the open
+    handles and the caches, is guarded by locks.
+
     :param ImageSource source: The image source.
 
     :param database: An override for the default database file for the
@@ -57,8 +77,90 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
     :param str date_format: The date format string used to construct file names
         from time stamps.
 
+    :param float attr_timeout: The number of seconds to cache the attributes of
+        file based images. If this is not positive, the attributes are read
+        from the file system on every request.
+
+    :param bool attr_inotify: Whether to watch the directories containing file
+        based images using *inotify*, and invalidate cached attributes when the
+        files change. This requires *pyinotify*.
+
+    :param int path_cache_size: The maximum number of resolved paths to cache.
+
+    :param float cache_timeout: The number of seconds the kernel may cache
+        entries and attributes. If this is positive, the kernel is also allowed
+        to keep cached file data when a file is reopened unchanged; this
+        requires that the file system is mounted with ``raw_fi`` set to
+        :attr:`raw_fi`. Unless the front end notifies the kernel of changes,
+        the timeout is limited to the refresh interval of the image source,
+        and cached file data is never kept.
+
+    :param int fd_pool_size: The maximum number of unused file descriptors to
+        keep open for file based images. If this is not positive, every open
+        opens the backing file.
+
+    :param int read_ahead_memory: The maximum number of bytes to prefetch for
+        files being read sequentially. If this is not positive, no data is
+        prefetched.
+
+    :param preview_path: The name of the top level directory containing
+        downscaled renditions of all images, using the same hierarchy as the
+        root directory. If this is not specified, no previews are provided.
+        This requires *Pillow*. Since the size of a preview is not known until
+        it has been generated, the file system must be mounted with ``raw_fi``
+        set to :attr:`raw_fi` to read previews.
+    :type preview_path: str or None
+
+    :param int preview_size: The maximum width and height of previews.
+
+    :param int preview_cache_size: The maximum total size of cached previews,
+        in bytes.
+
+    :param stats_path: The name of a top level directory containing the file
+        ``stats``, which provides metrics in the *Prometheus* text format. If
+        this is not specified, no metrics are collected. Since the size of the
+        file is not known in advance, the file system must be mounted with
+        ``raw_fi`` set to :attr:`raw_fi` to read it.
+    :type stats_path: str or None
+
+    :param timeline_path: The name of a top level directory containing all
+        images by date, in directories for every year, month and day. If this
+        is not specified, no timeline is provided.
+    :type timeline_path: str or None
+
+    :param trace_threshold: The minimum duration, in seconds, of operations to
+        log with the time spent in every phase. If this is not specified,
+        nothing is traced.
+    :type trace_threshold: float or None
+
+    :param profile_path: The file to which to write samples of all thread
+        stacks. If this is specified, the profiler is started and stopped
+        whenever :attr:`PROFILE_SIGNAL` is received, and the samples are
+        written when it is stopped.
+    :type profile_path: str or None
+
     :raises RuntimeError: if an error occurs
     """
+    #: The operations for which metrics are collected
+    OPERATIONS = (
+        'getattr', 'opendir', 'readdir', 'releasedir', 'open', 'read',
+        'release')
+
+    #: The name of the file containing metrics
+    STATS_FILE = 'stats'
+
+    #: The signal toggling the profiler
+    PROFILE_SIGNAL = signal.SIGUSR1
+
+    #: Whether the front end passes the attributes of directory entries on to
+    #: the kernel; the high level interface of libfuse 2 only uses their file
+    #: type, so unless attributes are cached, reading them is wasted
+    ENTRY_ATTRIBUTES = False
+
+    #: Whether :meth:`invalidate` notifies the kernel of changed paths; unless
+    #: it does, the kernel may not cache entries and attributes for longer
+    #: than the refresh interval of the image source
+    KERNEL_NOTIFICATIONS = False
 
     def __init__(
             self,
@@ -67,6 +169,19 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
             use_links=False,
             filters={},
             date_format='%Y-%m-%d, %H.%M',
+            attr_timeout=0.0,
+            attr_inotify=False,
+            path_cache_size=4096,
+            cache_timeout=0.0,
+            fd_pool_size=0,
+            read_ahead_memory=0,
+            preview_path=None,
+            preview_size=1024,
+            preview_cache_size=512 * 1024 * 1024,
+            stats_path=None,
+            timeline_path=None,
+            trace_threshold=None,
+            profile_path=None,
             **kwargs):
         super(PhotoFS, self).__init__()
 
@@ -79,10 +194,97 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
         self.dirstat = None
         self.image_source = None
 
+        # The open handles by ID; they are added and removed with the lock
+        # held, but looked up without it, since FUSE never reads from a handle
+        # while it is opened or released
         self.handles = {}
+        self._handles_lock = threading.Lock()
+
+        # The cursors of open directories by ID; they are guarded by the same
+        # lock as the open handles
+        self.directories = {}
+        self.descriptors = DescriptorPool(fd_pool_size) \
+            if fd_pool_size > 0 else None
+        self.read_ahead = ReadAhead(read_ahead_memory) \
+            if read_ahead_memory > 0 else None
+
+        # The preview directory, the cache of renditions, and the filters used
+        # for preview directories, by original filter
+        self.preview_path = preview_path
+        self.previews = PreviewCache(
+            os.path.join(
+                xdg_cache_home, 'photofs', 'previews', str(preview_size)),
+            preview_size,
+            preview_cache_size) if preview_path else None
+        self._preview_filters = {}
+
+        # The filter indices for the current generation of the image source;
+        # the lock ensures that every index is created only once
+        self._indices = (None, {})
+        self._indices_lock = threading.Lock()
+
+        # The timeline directory, and the timeline for the current generation
+        # of the image source; the lock ensures that it is created only once
+        self.timeline_path = timeline_path
+        self._timeline = (None, None)
+        self._timeline_lock = threading.Lock()
+
+        # The cached attributes of file based images, and the watcher of their
+        # backing directories; the watcher thread is started by init, since
+        # FUSE may fork before that
+        self.attributes = AttributeCache(attr_timeout)
+        self.watcher = DirectoryWatcher(self.attributes.invalidate) \
+            if attr_inotify else None
+
+        # The resolved paths for the current generation of the image source
+        self.paths = PathCache(path_cache_size)
+
+        # Whether fusepy passes the raw file info structure instead of the
+        # open flags
+        self.raw_fi = False
+
+        # The metrics, and the directory containing the metrics file; the raw
+        # file info structure is required to enable direct I/O for the file
+        self.stats_path = stats_path
+        self.metrics = Metrics(self.OPERATIONS) if stats_path else None
+        self._stats = None
+        self._tree_size = (None, 0, 0)
+        if self.metrics is not None:
+            self.metrics.add_collector(self._collect_metrics)
+            self.raw_fi = True
+
+        # The size of a preview is not known until it has been generated, so
+        # previews are read using direct I/O as well
+        if self.previews is not None:
+            self.raw_fi = True
+
+        # The tracer of slow operations, and the profiler; the signal toggling
+        # the profiler is handled by a dedicated thread, so it must be blocked
+        # in all other threads
+        self.tracer = Tracer(trace_threshold)
+        self.profiler = SamplingProfiler(profile_path) \
+            if profile_path else None
+        if self.profiler is not None:
+            SamplingProfiler.block(self.PROFILE_SIGNAL)
 
         # Create the image source
-        self.image_source = ImageSource.get(self.source)(**kwargs)
+        self.image_source = ImageSource.get(self.source)(
+            tracer=self.tracer,
+            **kwargs)
+
+        # The kernel cache policy, which requires the refresh interval of the
+        # image source; changed paths and keep_cache only matter if the kernel
+        # is notified of changes, and to set keep_cache when opening files,
+        # the raw file info structure is required
+        self.cache_policy = CachePolicy(
+            cache_timeout,
+            None if self.KERNEL_NOTIFICATIONS
+            else getattr(self.image_source, 'refresh_interval', 0.0))
+        if self.cache_policy.enabled and self.KERNEL_NOTIFICATIONS:
+            self.image_source.add_listener(self._tree_changed)
+            self.raw_fi = True
+        if self.watcher:
+            self.image_source.add_listener(self._watch)
 
         try:
             # Store the current time as timestamp for directories
@@ -90,6 +292,14 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
 
             # Use the lstat result of the mount point for all directories
             self.dirstat = os.lstat(mountpoint)
+            self.dirattrs = self._attributes(self.dirstat)
+
+            if self.metrics is not None:
+                self._stats = {
+                    self.STATS_FILE: MetricsFile(
+                        self.STATS_FILE,
+                        self.metrics,
+                        self.dirstat)}
 
         except Exception as e:
             try:
@@ -101,49 +311,341 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
                     'Failed to initialise file system: %s',
                     str(e))
 
+    def __call__(self, op, *args):
+        timed = self.metrics is not None and op in self.metrics
+        start = time.time()
+        try:
+            with self.tracer.trace(op, *args[:1]) as trace:
+                result = super(PhotoFS, self).__call__(op, *args)
+                if isinstance(result, types.GeneratorType):
+                    trace.defer()
+        except:
+            if timed:
+                self.metrics.observe(op, time.time() - start, True)
+            raise
+
+        if isinstance(result, types.GeneratorType):
+            # Directory listings read further pages while they are consumed
+            return self._consume(
+                op, trace, result, time.time() - start, timed)
+        elif timed:
+            self.metrics.observe(op, time.time() - start)
+        return result
+
+    def _consume(self, op, trace, result, duration, timed):
+        """Yields the items of a lazy result, counting the time spent producing
+        them as part of the operation.
+
+        The operation is traced and recorded in the metrics once the result
+        has been consumed or discarded.
+
+        :param str op: The name of the operation.
+
+        :param trace: The deferred trace of the operation.
+
+        :param result: The generator returned by the operation.
+
+        :param float duration: The time already spent in the operation.
+
+        :param bool timed: Whether to record the operation in the metrics.
+        """
+        error = False
+        try:
+            while True:
+                start = time.time()
+                try:
+                    with trace:
+                        item = next(result)
+                except StopIteration:
+                    return
+                except:
+                    error = True
+                    raise
+                finally:
+                    duration += time.time() - start
+                yield item
+        finally:
+            trace.finish()
+            if timed:
+                self.metrics.observe(op, duration, error)
+
+    def init(self, path):
+        self.image_source.start()
+        if self.watcher:
+            self.watcher.start()
+        if self.profiler is not None:
+            self.profiler.listen(self.PROFILE_SIGNAL)
+
     def destroy(self, path):
-        pass
+        self.image_source.stop()
+        if self.profiler is not None:
+            self.profiler.stop()
+        if self.descriptors is not None:
+            self.descriptors.clear()
+        if self.read_ahead is not None:
+            self.read_ahead.shutdown()
+        if self.previews is not None:
+            self.previews.shutdown()
+        if self.watcher:
+            self.watcher.stop()
+        logging.getLogger(__name__).info(
+            'Attribute cache: %d hits, %d misses',
+            self.attributes.hits,
+            self.attributes.misses)
+        logging.getLogger(__name__).info(
+            'Path cache: %d hits, %d misses, %d of %d entries',
+            self.paths.hits,
+            self.paths.misses,
+            len(self.paths),
+            self.paths.size)
+
+    def _collect_metrics(self):
+        """Collects the metrics not recorded by :meth:`__call__`.
+
+        See :meth:`photofs._metrics.Metrics.add_collector` for a description
+        of the return value.
+        """
+        source = self.image_source
+        tree = source.root
+        generation, tags, images = self._tree_size
+        if generation != tree.generation:
+            tags, images = self._count(tree)
+            self._tree_size = (tree.generation, tags, images)
 
-    def recursive_filter(self, item, include):
-        """The recursive filter used to actually filter the image source.
+        yield (
+            'refreshes_total', 'counter',
+            'The number of times the image source has been loaded.',
+            [({}, source.refreshes)])
+        yield (
+            'refresh_duration_seconds_total', 'counter',
+            'The total time spent loading the image source.',
+            [({}, source.refresh_duration)])
+        yield (
+            'refresh_last_duration_seconds', 'gauge',
+            'The time spent loading the image source the last time.',
+            [({}, source.last_refresh_duration)])
+        yield (
+            'tree_generation', 'gauge',
+            'The generation of the published tree.',
+            [({}, tree.generation)])
+        yield (
+            'tree_tags', 'gauge',
+            'The number of tags in the published tree.',
+            [({}, tags)])
+        yield (
+            'tree_images', 'gauge',
+            'The number of distinct images in the published tree.',
+            [({}, images)])
+        yield (
+            'open_handles', 'gauge',
+            'The number of open file handles.',
+            [({}, len(self.handles))])
+        yield (
+            'open_directories', 'gauge',
+            'The number of open directories.',
+            [({}, len(self.directories))])
 
-        This function will simply call include_filter in the outer scope if
-        item is an instance of :class:`Image`, otherwise it will recursively
-        call itself on all items in the tag, and return whether the filtered
-        tag contains any subitems.
+        caches = [('attributes', self.attributes), ('paths', self.paths)]
+        if self.descriptors is not None:
+            caches.append(('descriptors', self.descriptors))
+        if self.read_ahead is not None:
+            caches.append(('read_ahead', self.read_ahead))
+        yield (
+            'cache_hits_total', 'counter',
+            'The number of cache hits.',
+            [({'cache': name}, cache.hits) for name, cache in caches])
+        yield (
+            'cache_misses_total', 'counter',
+            'The number of cache misses.',
+            [({'cache': name}, cache.misses) for name, cache in caches])
+        yield (
+            'path_cache_entries', 'gauge',
+            'The number of cached resolved paths.',
+            [({}, len(self.paths))])
+        if self.read_ahead is not None:
+            yield (
+                'read_ahead_bytes', 'gauge',
+                'The number of bytes currently prefetched.',
+                [({}, self.read_ahead.used)])
+        if self.previews is not None:
+            yield (
+                'preview_cache_bytes', 'gauge',
+                'The total size of cached previews.',
+                [({}, self.previews.total)])
 
-        :param item: The item to filter.
-        :type item: Image or Tag
+    def _count(self, tree):
+        """Counts the tags and distinct images of a tree.
 
-        :return: ``True`` if the item should be kept and ``False``
-            otherwise
+        :param Tree tree: The tree.
+
+        :return: the tuple ``(tags, images)``
         """
-        if isinstance(item, Image):
-            return include(item)
-        elif isinstance(item, Tag):
-            return any(
-                self.recursive_filter(item, include)
-                for item in item.values())
-        else:
-            return False
+        tags = 0
+        images = set()
+        stack = [tree]
+        while stack:
+            for item in stack.pop().values():
+                if isinstance(item, dict):
+                    tags += 1
+                    stack.append(item)
+                else:
+                    images.add(id(item))
+        images.update(id(image) for image in tree.untagged)
+
+        return tags, len(images)
+
+    def filter_index(self, include, tree):
+        """Returns the filter index for a filter function.
+
+        Indices are created on demand, and are discarded when a tree with a
+        newer generation is published by the image source.
+
+        :param include: The filter function, or ``None`` to include all
+            images.
+
+        :param Tree tree: The tree to which the index applies.
+
+        :return: the index for ``tree``
+        :rtype: FilterIndex
+        """
+        generation, indices = self._indices
+        if generation == tree.generation:
+            try:
+                return indices[include]
+            except KeyError:
+                pass
+
+        with self._indices_lock:
+            generation, indices = self._indices
+            if generation != tree.generation:
+                # Only keep indices for the most recent tree; readers still
+                # using an older tree get a temporary index
+                indices = {}
+                if generation is None or generation < tree.generation:
+                    self._indices = (tree.generation, indices)
+
+            try:
+                return indices[include]
+            except KeyError:
+                index = indices[include] = FilterIndex(tree, include)
+                return index
 
-    def locate(self, path):
+    def timeline(self, tree):
+        """Returns the timeline of a tree.
+
+        The timeline is created on demand, and is discarded when a tree with a
+        newer generation is published by the image source.
+
+        :param Tree tree: The tree.
+
+        :return: the timeline for ``tree``
+        :rtype: Timeline
+        """
+        generation, timeline = self._timeline
+        if generation == tree.generation:
+            return timeline
+
+        with self._timeline_lock:
+            generation, timeline = self._timeline
+            if generation == tree.generation:
+                return timeline
+
+            # Readers still using an older tree get a temporary timeline
+            timeline = Timeline(tree)
+            if generation is None or generation < tree.generation:
+                self._timeline = (tree.generation, timeline)
+            return timeline
+
+    def locate(self, path, tree=None):
         """Locates a filter function and an image or tag resource.
 
-        If the path denotes the root, :attr:`self.image_source` is returned
+        If the path denotes the root, the filters are returned if any are
+        registered, otherwise the tree of the image source.
 
         :param str path: The absolute path of the resource. This must begin
             with :attr:`os.path.sep`.
 
+        :param tree: The tree in which to locate the resource. If this is not
+            specified, the tree currently published by the image source is
+            used.
+        :type tree: Tree or None
+
         :return: the tuple ``(include, resource)``, where ``include`` is
             ``None`` if no filters are registered
 
         :raises KeyError: if the resource does not exist using the filter
         """
+        if tree is None:
+            tree = self.image_source.root
+
+        with phase('locate'):
+            return self.paths.get(
+                tree.generation,
+                path,
+                lambda: self._locate(path, tree))
+
+    def _tree_changed(self, previous, tree):
+        """Invalidates cached data for all paths that differ between two
+        trees.
+
+        :param Tree previous: The previously published tree.
+
+        :param Tree tree: The new tree.
+        """
+        paths = set()
+        for path in tree.diff(previous):
+            if self.filters:
+                paths.update(
+                    os.path.sep + root + (path if path != os.path.sep else '')
+                    for root in self.filters)
+            else:
+                paths.add(path)
+
+        self.cache_policy.invalidate(paths)
+        self.invalidate(paths)
+
+    def invalidate(self, paths):
+        """Notifies the kernel that paths have changed.
+
+        The *fusepy* high level interface cannot notify the kernel, so this
+        implementation does nothing; cached entries expire after the timeout
+        of the cache policy. Front ends supporting notifications should
+        override this method.
+
+        :param paths: The changed paths in the mounted file system.
+        """
+        pass
+
+    def _locate(self, path, tree):
+        """Locates a filter function and an image or tag resource without
+        using the path cache.
+
+        See :meth:`locate` for a description of the parameters.
+        """
         # The root path corresponds to the filters, if any registered, or the
         # image source root tags
         if path == os.path.sep:
-            return (None, self.filters or self.image_source)
+            return (None, self.filters or tree)
+
+        # The stats directory contains only the metrics file
+        if self.stats_path:
+            root, rest = self.split_path(path)
+            if root == self.stats_path:
+                return (None, self._stats[rest] if rest else self._stats)
+
+        # The timeline directory contains all images by date
+        if self.timeline_path:
+            root, rest = self.split_path(path)
+            if root == self.timeline_path:
+                with phase('timeline'):
+                    return (None, self.timeline(tree).locate(
+                        rest.split(os.path.sep) if rest else []))
+
+        # The preview directory mirrors the root directory
+        if self.preview_path:
+            root, rest = self.split_path(path)
+            if root == self.preview_path:
+                return self._locate_preview(os.path.sep + rest, tree)
 
         # If any filters are registered, the first part of the path is the
         # filter name; the filter must allow the item
@@ -151,8 +653,10 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
             root, rest = self.split_path(path)
             include = self.filters[root]
             if rest:
-                item = self.image_source.locate(os.path.sep + rest)
-                if not self.recursive_filter(item, include):
+                item = self.image_source.locate(os.path.sep + rest, tree)
+                with phase('filter'):
+                    included = self.filter_index(include, tree).includes(item)
+                if not included:
                     raise KeyError(path)
             path = os.path.sep + rest
         else:
@@ -160,7 +664,62 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
 
         return (
             include,
-            self.image_source.locate(path) if path else self.image_source)
+            self.image_source.locate(path, tree) if path else tree)
+
+    def _locate_preview(self, path, tree):
+        """Locates a filter function and a preview or tag resource beneath
+        the preview directory.
+
+        :param str path: The absolute path of the resource relative to the
+            preview directory.
+
+        :param Tree tree: The tree in which to locate the resource.
+
+        :return: the tuple ``(include, resource)``, where ``include`` is a
+            :class:`PreviewFilter`
+
+        :raises KeyError: if the resource does not exist using the filter
+        """
+        name = os.path.basename(path)
+        try:
+            include, item = self._locate(path, tree)
+            if isinstance(item, Image) and preview_name(name, item) != name:
+                raise KeyError(path)
+        except KeyError:
+            # Previews stored in another format than their originals have the
+            # extension of that format appended to the name of the original
+            original, extension = os.path.splitext(path)
+            if not extension:
+                raise
+            include, item = self._locate(original, tree)
+            if not isinstance(item, Image) or \
+                    preview_name(os.path.basename(original), item) != name:
+                raise KeyError(path)
+
+        if item is self.filters:
+            return (include, item)
+
+        try:
+            include = self._preview_filters[include]
+        except KeyError:
+            include = self._preview_filters.setdefault(
+                include,
+                PreviewFilter(include))
+
+        if item is tree:
+            return (include, item)
+
+        elif isinstance(item, Image):
+            if not include(item):
+                raise KeyError(path)
+            return (include, Preview(item, self.previews))
+
+        with phase('filter'):
+            included = self.filter_index(include, tree).includes(item)
+        if not included:
+            raise KeyError(path)
+
+        return (include, item)
 
     def split_path(self, path):
         """Returns the tuple ``(root, rest)`` for a path, where ``root`` is the
@@ -185,30 +744,14 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
         else:
             return (path, '')
 
-    def getattr(self, path, fh=None):
-        try:
-            include, item = self.locate(path)
+    def _attributes(self, st):
+        """Creates the attribute record returned by :meth:`getattr`.
 
-        except KeyError:
-            raise fuse.FuseOSError(errno.ENOENT)
-
-        if self.use_links and isinstance(item, FileBasedImage):
-            # This is a link
-            st = os.stat_result((item.stat[0] | stat.S_IFLNK,) + item.stat[1:])
-
-        elif isinstance(item, Image):
-            # This is a file
-            st = item.stat
-
-        elif isinstance(item, dict):
-            # This is a directory; this matches both Tag and ImageSource
-            st = self.dirstat
-
-        else:
-            raise RuntimeError(
-                'Unknown object: %s',
-                path)
+        :param os.stat_result st: The ``stat`` value of the item.
 
+        :return: the attributes
+        :rtype: dict
+        """
         return dict(
             # Remove write permission bits
             st_mode=st.st_mode & ~(
@@ -225,59 +768,286 @@ class PhotoFS(fuse.LoggingMixIn, fuse.Operations):
 
             st_size=st.st_size)
 
-    def readdir(self, path, offset):
+    def _image_attributes(self, item, st=None):
+        """Creates the attribute record for an image.
+
+        :param Image item: The image.
+
+        :param os.stat_result st: The ``stat`` value of the image, if it has
+            already been read.
+
+        :return: the attributes
+        :rtype: dict
+        """
+        if st is None:
+            with phase('stat'):
+                st = item.stat
+
+        if self.use_links and isinstance(item, FileBasedImage):
+            # This is a link
+            return self._attributes(
+                os.stat_result((st[0] | stat.S_IFLNK,) + st[1:]))
+
+        else:
+            # This is a file
+            return self._attributes(st)
+
+    def _entries(self, tag, names, previews=False):
+        """Creates the directory entries listed by :meth:`readdir`.
+
+        If the front end passes the attributes of entries on to the kernel,
+        or if attributes are cached, the attributes of all file based images
+        are read in one batch, using the image source if it supports it, and
+        are stored in the attribute cache. Otherwise, and for images that are
+        not file based, since reading them may be expensive, images are listed
+        without attributes.
+
+        :param dict tag: The directory.
+
+        :param [str] names: The names to list.
+
+        :param bool previews: Whether the directory is beneath the preview
+            directory. The images are then listed without attributes, and
+            their previews are requested.
+
+        :return: a list of tuples ``(name, attrs)``, where ``attrs`` is
+            ``None`` if not known
+        """
+        entries = []
+        images = []
+        for name in names:
+            item = tag[name]
+            if isinstance(item, dict):
+                entries.append((name, self.dirattrs))
+                continue
+            elif previews:
+                # Start generating the previews of all listed images
+                try:
+                    self.previews.request(item)
+                except OSError:
+                    pass
+                name = preview_name(name, item)
+            elif isinstance(item, FileBasedImage):
+                images.append((len(entries), item))
+            entries.append((name, None))
+
+        if images and (self.ENTRY_ATTRIBUTES or self.attributes.timeout > 0):
+            items = dict((item.location, item) for _, item in images)
+            stat_files = getattr(self.image_source, 'stat_files', None)
+
+            def build(locations):
+                with phase('stat'):
+                    if stat_files is not None:
+                        stats = stat_files(locations)
+                    else:
+                        stats = []
+                        for location in locations:
+                            try:
+                                stats.append(os.lstat(location))
+                            except OSError:
+                                stats.append(None)
+                return [
+                    self._image_attributes(items[location], st)
+                    if st is not None else None
+                    for location, st in zip(locations, stats)]
+
+            locations = [item.location for _, item in images]
+            for (i, item), attrs in zip(
+                    images,
+                    self.attributes.get_all(locations, build)):
+                entries[i] = (entries[i][0], attrs)
+
+        return entries
+
+    def _cursor(self, path):
+        """Creates a cursor listing a directory in the tree currently
+        published by the image source.
+
+        :param str path: The absolute path of the directory.
+
+        :return: a cursor
+        :rtype: Cursor
+
+        :raises fuse.FuseOSError: if the path does not exist or is not a
+            directory
+        """
+        tree = self.image_source.root
+        directory = lambda names: [(k, self.dirattrs) for k in names]
         if path == os.path.sep:
-            return [
-                k
-                for k in (self.filters or self.image_source)]
+            return Cursor(
+                list(self.filters or tree) + [
+                    k
+                    for k in (
+                        self.timeline_path,
+                        self.preview_path,
+                        self.stats_path)
+                    if k],
+                directory)
 
         try:
-            include, item = self.locate(path)
+            include, item = self.locate(path, tree)
 
         except KeyError:
             raise fuse.FuseOSError(errno.ENOENT)
 
-        if isinstance(item, dict):
-            # This is a directory; this matches both Tag and
-            # ImageSource
-            return [
-                k
-                for k, v in item.items()
-                if self.recursive_filter(v, include)]
+        if item is self.filters:
+            # This is the preview directory
+            return Cursor(list(self.filters), directory)
+
+        elif item is self._stats:
+            return Cursor(
+                list(self._stats),
+                lambda names: [
+                    (k, self._image_attributes(self._stats[k]))
+                    for k in names])
+
+        elif isinstance(item, Period):
+            return Cursor(
+                item.names,
+                lambda names: self._entries(item, names))
+
+        elif isinstance(item, dict):
+            # This is a directory; this matches both Tag and Tree
+            with phase('filter'):
+                listing = self.filter_index(include, tree).listing(item)
+            previews = isinstance(include, PreviewFilter)
+            return Cursor(
+                listing,
+                lambda names: self._entries(item, names, previews))
+
+        else:
+            raise fuse.FuseOSError(errno.ENOTDIR)
+
+    def _watch(self, previous, tree):
+        """Makes sure that the directories of all file based images of a newly
+        published tree are watched.
+
+        This is called from the thread publishing the tree, so that no
+        operation waits for the tree to be walked.
+
+        :param Tree previous: The previously published tree.
+
+        :param Tree tree: The new tree.
+        """
+        self.watcher.watch(set(
+            os.path.dirname(image.location)
+            for image in tree.images()
+            if isinstance(image, FileBasedImage)))
+
+    def getattr(self, path, fh=None):
+        tree = self.image_source.root
+        try:
+            include, item = self.locate(path, tree)
+
+        except KeyError:
+            raise fuse.FuseOSError(errno.ENOENT)
+
+        if isinstance(item, FileBasedImage):
+            return self.attributes.get(
+                item.location,
+                lambda: self._image_attributes(item))
+
+        elif isinstance(item, Image):
+            return self._image_attributes(item)
+
+        elif isinstance(item, dict):
+            # This is a directory; this matches both Tag and Tree
+            return self.dirattrs
 
         else:
             raise RuntimeError(
                 'Unknown object: %s',
-                os.path.join(root, path))
+                path)
+
+    def opendir(self, path):
+        # The cursor keeps the listing of the tree published when the
+        # directory was opened, so offsets remain valid until it is released
+        cursor = self._cursor(path)
+        with self._handles_lock:
+            self.directories[id(cursor)] = cursor
+        return id(cursor)
+
+    def readdir(self, path, fh, offset=0):
+        # Entries are returned with any attributes read by _entries;
+        # directories read without being opened are listed from the current
+        # tree
+        cursor = self.directories.get(fh)
+        if cursor is None:
+            cursor = self._cursor(path)
+        return cursor.entries(offset)
+
+    def releasedir(self, path, fh):
+        with self._handles_lock:
+            self.directories.pop(fh, None)
 
     def readlink(self, path):
-        include, item = self.locate(path)
+        try:
+            include, item = self.locate(path)
+        except KeyError:
+            raise fuse.FuseOSError(errno.ENOENT)
         try:
             return item.location
         except:
             raise fuse.FuseOSError(errno.EINVAL)
 
     def open(self, path, flags):
-        include, item = self.locate(path)
-        if isinstance(item, Image):
-            handle = item.open(flags)
-            self.handles[id(handle)] = (handle, threading.Lock())
+        # If raw_fi is set, flags is the file info structure
+        fi = flags if self.raw_fi else None
+        try:
+            include, item = self.locate(path)
+        except KeyError:
+            raise fuse.FuseOSError(errno.ENOENT)
+        with phase('io'):
+            if isinstance(item, FileBasedImage) and \
+                    self.descriptors is not None:
+                handle = self.descriptors.open(item.location)
+            elif isinstance(item, Image):
+                handle = item.open_handle(fi.flags if fi else flags)
+            else:
+                raise fuse.FuseOSError(errno.EINVAL)
+        if self.read_ahead is not None and not isinstance(item, MetricsFile):
+            handle = self.read_ahead.wrap(handle)
+
+        with self._handles_lock:
+            self.handles[id(handle)] = handle
+        if fi is None:
             return id(handle)
+
+        fi.fh = id(handle)
+        if isinstance(item, (MetricsFile, Preview)):
+            # The size of the metrics file and of previews is unknown
+            fi.direct_io = True
         else:
-            raise fuse.FuseOSError(errno.EINVAL)
+            fi.keep_cache = self.cache_policy.keep_cache(
+                path,
+                self._signature(item))
+        return 0
+
+    def _signature(self, item):
+        """Returns a value identifying the content of an image.
+
+        :param Image item: The image.
+
+        :return: a value that changes when the content changes
+        """
+        if isinstance(item, FileBasedImage):
+            with phase('stat'):
+                st = item.stat
+            return (item.location, st.st_mtime, st.st_size)
+        else:
+            return (id(item),)
 
     def release(self, path, fh):
         try:
-            handle, lock = self.handles[fh]
-            with lock:
+            with self._handles_lock:
+                handle = self.handles.pop(fh.fh if self.raw_fi else fh)
+            with phase('io'):
                 handle.close()
-            del self.handles[fh]
         except:
             raise fuse.FuseOSError(errno.EINVAL)
 
     def read(self, path, size, offset, fh):
-        handle, lock = self.handles[fh]
-        with lock:
-            if handle.tell() != offset:
-                handle.seek(offset)
-            return handle.read(size)
+        with phase('io'):
+            return self.handles[fh.fh if self.raw_fi else fh].read_at(
+                size,
+                offset)
@@ -79,6 +79,93 @@ def main():
         '--date-format',
         help='The format to use for timestamps.')
 
+    parser.add_argument(
+        '--attr-timeout',
+        help='The number of seconds to cache file attributes. The default is '
+        'to not cache them.',
+        type=float)
+
+    parser.add_argument(
+        '--attr-inotify',
+        help='Invalidate cached file attributes when files change. This '
+        'requires pyinotify.',
+        action='store_true')
+
+    parser.add_argument(
+        '--path-cache-size',
+        help='The maximum number of resolved paths to cache.',
+        type=int)
+
+    parser.add_argument(
+        '--cache-timeout',
+        help='The number of seconds the kernel may cache entries and '
+        'attributes, and whether to keep cached file data for unchanged '
+        'files. Changes to the database may not be visible until the timeout '
+        'has passed. With the fusepy backend, the kernel cannot be notified '
+        'of changes, so the timeout is limited to the refresh interval and '
+        'cached file data is never kept.',
+        type=float)
+
+    parser.add_argument(
+        '--fd-pool-size',
+        help='The maximum number of unused file descriptors to keep open for '
+        'quickly reopening images.',
+        type=int)
+
+    parser.add_argument(
+        '--read-ahead-memory',
+        help='The maximum number of megabytes to prefetch for files being '
+        'read sequentially.',
+        type=lambda value: int(float(value) * 1024 * 1024))
+
+    parser.add_argument(
+        '--preview-path',
+        help='The name of a top level directory containing downscaled '
+        'previews of all images. This requires Pillow.')
+
+    parser.add_argument(
+        '--preview-size',
+        help='The maximum width and height of previews.',
+        type=int)
+
+    parser.add_argument(
+        '--preview-cache-size',
+        help='The maximum number of megabytes of cached previews.',
+        type=lambda value: int(float(value) * 1024 * 1024))
+
+    parser.add_argument(
+        '--stats-path',
+        help='The name of a top level directory containing the file stats, '
+        'which provides metrics in the Prometheus text format. Use a name '
+        'beginning with a dot, such as .photofs, to hide the directory. If '
+        'this is not specified, no metrics are collected.')
+
+    parser.add_argument(
+        '--timeline-path',
+        help='The name of a top level directory containing all images by '
+        'date, in directories for every year, month and day. Directories '
+        'named like 2016-01..2016-03 beneath it contain all images in a range '
+        'of years, months or days.')
+
+    parser.add_argument(
+        '--trace-threshold',
+        help='Log operations taking longer than this number of seconds, with '
+        'the time spent in every phase.',
+        type=float)
+
+    parser.add_argument(
+        '--profile-path',
+        help='Start and stop a sampling profiler when receiving SIGUSR1, and '
+        'write the samples to this file when stopped. The samples are in the '
+        'collapsed stack format used by flame graph tools.')
+
+    parser.add_argument(
+        '--backend',
+        help='The FUSE binding to use; pyfuse3 handles requests '
+        'asynchronously, and always runs in the foreground.',
+        choices=('fusepy', 'pyfuse3'),
+        default='fusepy')
+
     fuse_args = {}
 
     class OAction(argparse.Action):
@@ -113,8 +200,29 @@ def main():
         if name in args})
 
     try:
+        if args.pop('backend') == 'pyfuse3':
+            from photofs._async import AsyncPhotoFS, mount
+            photo_fs = AsyncPhotoFS(filters=filter_type.filters, **args)
+            mount(
+                photo_fs,
+                args['mountpoint'],
+                [
+                    name if value is True else '%s=%s' % (name, value)
+                    for name, value in fuse_args.items()
+                    if name not in ('foreground', 'debug')],
+                fuse_args.get('debug', False))
+            return
+
         photo_fs = PhotoFS(filters=filter_type.filters, **args)
-        fuse.FUSE(photo_fs, args['mountpoint'], fsname='photofs', **fuse_args)
+
+        # Let the cache policy provide defaults for the FUSE options
+        for name, value in photo_fs.cache_policy.fuse_options().items():
+            fuse_args.setdefault(name, value)
+        if photo_fs.raw_fi:
+            fuse_args['raw_fi'] = True
+
+        from photofs._fusepy import FUSE
+        FUSE(photo_fs, args['mountpoint'], fsname='photofs', **fuse_args)
     except Exception as e:
         import traceback
         traceback.print_exc()
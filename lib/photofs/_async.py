@@ -0,0 +1,458 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import errno
+import itertools
+import os
+import threading
+
+try:
+    import pyfuse3
+    import trio
+except ImportError:
+    pyfuse3 = None
+
+from . import PhotoFS
+from ._metrics import MetricsFile
+
+
+class _FileInfo(object):
+    """The attributes of the *fusepy* file info structure used by
+    :class:`photofs.PhotoFS`.
+    """
+    def __init__(self, flags):
+        self.flags = flags
+        self.fh = 0
+        self.direct_io = False
+        self.keep_cache = False
+
+
+class _Core(PhotoFS):
+    """The path based file system used by :class:`AsyncPhotoFS`.
+
+    Notifications of changed paths are forwarded to the front end, and the
+    attributes of directory entries are passed on to the kernel.
+    """
+    ENTRY_ATTRIBUTES = True
+
+    KERNEL_NOTIFICATIONS = True
+
+    def __init__(self, frontend, *args, **kwargs):
+        self._frontend = frontend
+        super(_Core, self).__init__(*args, **kwargs)
+
+    def invalidate(self, paths):
+        self._frontend.invalidate(paths)
+
+
+class AsyncPhotoFS(pyfuse3.Operations if pyfuse3 else object):
+    """An implementation of a *FUSE* file system using the inode based
+    interface of *pyfuse3*.
+
+    The file system is presented exactly as by :class:`photofs.PhotoFS`; all
+    requests are translated to paths and passed to an instance of that class,
+    so all its caches and options apply. Inodes are allocated for paths when
+    the kernel looks them up, and are released when the kernel forgets them.
+
+    Requests are handled concurrently by *trio* tasks. Requests that may
+    block, such as lookups and attribute requests reading backing files,
+    opening, reading and closing files, and listings requiring many attribute
+    lookups or previews, are run on worker threads; cheap requests, such as
+    reading the metrics file and listing pages already read, are handled
+    directly on the event loop.
+
+    The handlers may be called without mounting the file system; they are
+    coroutines, and may be run with :func:`trio.run`.
+
+    This requires *pyfuse3*. All arguments are passed to
+    :class:`photofs.PhotoFS`.
+
+    :raises RuntimeError: if *pyfuse3* is not available, or if an error occurs
+    """
+    #: The maximum number of directory entries without attributes that are
+    #: completed directly on the event loop; larger batches, and entries in
+    #: the preview directory, are completed on a worker thread
+    INLINE_READDIR = 64
+
+    #: The maximum number of worker threads
+    WORKERS = 16
+
+    def __init__(self, *args, **kwargs):
+        if pyfuse3 is None:
+            raise RuntimeError('The asynchronous front end requires pyfuse3')
+        super(AsyncPhotoFS, self).__init__()
+        self.core = _Core(self, *args, **kwargs)
+        self._limiter = trio.CapacityLimiter(self.WORKERS)
+
+        # The inodes by path, the paths by inode, and the lookup counts by
+        # inode
+        self._lock = threading.Lock()
+        self._inodes = {os.path.sep: pyfuse3.ROOT_INODE}
+        self._paths = {pyfuse3.ROOT_INODE: os.path.sep}
+        self._lookups = {}
+        self._next_inode = itertools.count(pyfuse3.ROOT_INODE + 1)
+
+        # The open directories and files by handle
+        self._directories = {}
+        self._files = {}
+        self._next_handle = itertools.count(1)
+
+    def init(self):
+        self.core.init(os.path.sep)
+
+    def destroy(self):
+        """Stops all background activity.
+
+        *pyfuse3* has no corresponding request, so this must be called once
+        the file system has been unmounted.
+        """
+        self.core.destroy(os.path.sep)
+
+    def _call(self, op, *args):
+        """Invokes an operation of the path based file system.
+
+        :param str op: The name of the operation.
+
+        :param args: The arguments.
+
+        :return: the return value of the operation
+
+        :raises pyfuse3.FUSEError: if the operation fails
+        """
+        try:
+            return self.core(op, *args)
+        except OSError as e:
+            # This includes FuseOSError; like fusepy, report other errors
+            # with their errno
+            raise pyfuse3.FUSEError(e.errno or errno.EIO)
+        except KeyError:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+
+    async def _run(self, inline, function, *args):
+        """Runs a function either directly or on a worker thread.
+
+        :param bool inline: Whether to run the function directly on the event
+            loop.
+
+        :param function: The function to run.
+
+        :param args: The arguments.
+
+        :return: the return value of ``function``
+        """
+        if inline:
+            return function(*args)
+        else:
+            return await trio.to_thread.run_sync(
+                function,
+                *args,
+                limiter=self._limiter)
+
+    def _path(self, inode):
+        """Returns the path of an inode.
+
+        :param int inode: The inode.
+
+        :return: the path
+
+        :raises pyfuse3.FUSEError: if the inode is unknown
+        """
+        try:
+            return self._paths[inode]
+        except KeyError:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+
+    def _inode(self, path, lookup=True):
+        """Returns the inode of a path, allocating one if necessary.
+
+        :param str path: The path.
+
+        :param bool lookup: Whether to increment the lookup count of the
+            inode.
+
+        :return: the inode
+        :rtype: int
+        """
+        with self._lock:
+            inode = self._inodes.get(path)
+            if inode is None:
+                inode = self._inodes[path] = next(self._next_inode)
+                self._paths[inode] = path
+            if lookup:
+                self._lookups[inode] = self._lookups.get(inode, 0) + 1
+            return inode
+
+    def _entry(self, inode, attrs):
+        """Creates the entry attributes for an attribute record.
+
+        :param int inode: The inode.
+
+        :param dict attrs: The attributes returned by
+            :meth:`photofs.PhotoFS.getattr`.
+
+        :return: the entry attributes
+        :rtype: pyfuse3.EntryAttributes
+        """
+        entry = pyfuse3.EntryAttributes()
+        entry.st_ino = inode
+        entry.generation = 0
+        entry.entry_timeout = self.core.cache_policy.timeout
+        entry.attr_timeout = self.core.cache_policy.timeout
+        entry.st_mode = attrs['st_mode']
+        entry.st_nlink = attrs['st_nlink']
+        entry.st_uid = attrs['st_uid']
+        entry.st_gid = attrs['st_gid']
+        entry.st_size = attrs['st_size']
+        entry.st_blksize = 512
+        entry.st_blocks = (attrs['st_size'] + 511) // 512
+        entry.st_atime_ns = int(attrs['st_atime'] * 1e9)
+        entry.st_mtime_ns = int(attrs['st_mtime'] * 1e9)
+        entry.st_ctime_ns = int(attrs['st_ctime'] * 1e9)
+        return entry
+
+    async def lookup(self, parent_inode, name, ctx=None):
+        path = os.path.join(self._path(parent_inode), os.fsdecode(name))
+        attrs = await self._run(False, self._call, 'getattr', path)
+        return self._entry(self._inode(path), attrs)
+
+    async def forget(self, inode_list):
+        with self._lock:
+            for inode, nlookup in inode_list:
+                count = self._lookups.get(inode, 0) - nlookup
+                if count > 0 or inode == pyfuse3.ROOT_INODE:
+                    self._lookups[inode] = count
+                    continue
+                self._lookups.pop(inode, None)
+                path = self._paths.pop(inode, None)
+                if path is not None:
+                    del self._inodes[path]
+
+    async def getattr(self, inode, ctx=None):
+        return self._entry(inode, await self._run(
+            False,
+            self._call,
+            'getattr',
+            self._path(inode)))
+
+    async def readlink(self, inode, ctx=None):
+        return os.fsencode(self._call('readlink', self._path(inode)))
+
+    async def opendir(self, inode, ctx=None):
+        path = self._path(inode)
+
+        # The cursor keeps the listing of the tree published when the
+        # directory was opened, so offsets remain valid even if a new tree is
+        # published; it is created on a worker thread, since the filter index
+        # may have to be created
+        cursor = await self._run(False, self._call, 'opendir', path)
+        handle = next(self._next_handle)
+        self._directories[handle] = (path, cursor)
+        return handle
+
+    async def readdir(self, fh, start_id, token):
+        path, cursor_id = self._directories[fh]
+        cursor = self.core.directories[cursor_id]
+
+        # Reading the attributes of previews may require generating them
+        previews = self.core.preview_path and \
+            self.core.split_path(path)[0] == self.core.preview_path
+        while start_id < len(cursor):
+            # Pages not yet read are read on a worker thread; only entries
+            # already read are taken from the cursor on the event loop
+            entries = await self._run(
+                cursor.cached(start_id),
+                self._call,
+                'readdir',
+                path,
+                cursor_id,
+                start_id)
+            batch = []
+            for entry in entries:
+                batch.append(entry)
+                if not cursor.cached(entry[2]):
+                    break
+
+            missing = sum(1 for _, attrs, _ in batch if attrs is None)
+            if missing:
+                batch = await self._run(
+                    not previews and missing <= self.INLINE_READDIR,
+                    self._complete_entries,
+                    path,
+                    batch)
+
+            for name, attrs, next_id in batch:
+                if attrs is None:
+                    # The item has disappeared since the directory was opened
+                    start_id = next_id
+                    continue
+                # The lookup count is incremented only if the entry is
+                # accepted
+                child = os.path.join(path, name)
+                inode = self._inode(child, False)
+                if not pyfuse3.readdir_reply(
+                        token,
+                        os.fsencode(name),
+                        self._entry(inode, attrs),
+                        next_id):
+                    return
+                start_id = next_id
+                with self._lock:
+                    self._lookups[inode] = self._lookups.get(inode, 0) + 1
+
+    def _complete_entries(self, path, entries):
+        """Reads the attributes of directory entries listed without them.
+
+        :param str path: The path of the directory.
+
+        :param entries: The entries returned by
+            :meth:`photofs.PhotoFS.readdir`.
+
+        :return: a list of tuples ``(name, attrs, next)``, where ``attrs`` is
+            ``None`` for entries that no longer exist
+        """
+        result = []
+        for name, attrs, next_id in entries:
+            if attrs is None:
+                try:
+                    attrs = self._call('getattr', os.path.join(path, name))
+                except pyfuse3.FUSEError:
+                    pass
+            result.append((name, attrs, next_id))
+        return result
+
+    async def releasedir(self, fh):
+        directory = self._directories.pop(fh, None)
+        if directory is not None:
+            self._call('releasedir', *directory)
+
+    async def open(self, inode, flags, ctx=None):
+        fi, handle, in_memory = await self._run(
+            False,
+            self._open,
+            self._path(inode),
+            flags)
+        fh = next(self._next_handle)
+        self._files[fh] = handle
+        return pyfuse3.FileInfo(
+            fh=fh,
+            direct_io=fi.direct_io,
+            keep_cache=fi.keep_cache)
+
+    def _open(self, path, flags):
+        """Opens a file of the path based file system.
+
+        :param str path: The path of the file.
+
+        :param int flags: The flags passed by *FUSE*.
+
+        :return: the tuple ``(fi, handle, in_memory)``, where ``fi`` is the
+            file info structure passed to :meth:`photofs.PhotoFS.open`,
+            ``handle`` the tuple stored for the open file, and ``in_memory``
+            whether the file is rendered in memory
+
+        :raises pyfuse3.FUSEError: if the file cannot be opened
+        """
+        core = self.core
+        try:
+            item = core.locate(path)[1]
+        except KeyError:
+            raise pyfuse3.FUSEError(errno.ENOENT)
+
+        # The metrics file is rendered in memory, so it is read directly
+        in_memory = isinstance(item, MetricsFile)
+        fi = _FileInfo(flags)
+        result = self._call('open', path, fi if core.raw_fi else flags)
+        return (
+            fi,
+            (path, fi if core.raw_fi else result, in_memory),
+            in_memory)
+
+    async def read(self, fh, off, size):
+        path, handle, in_memory = self._files[fh]
+        return await self._run(
+            in_memory,
+            self._call,
+            'read',
+            path,
+            size,
+            off,
+            handle)
+
+    async def release(self, fh):
+        # Closing a handle may wait for reads in progress
+        path, handle, in_memory = self._files.pop(fh)
+        await self._run(in_memory, self._call, 'release', path, handle)
+
+    def invalidate(self, paths):
+        """Notifies the kernel that paths have changed.
+
+        Only paths the kernel has looked up are notified. The notifications
+        are sent from a separate thread, since they must not be sent while a
+        request is being handled.
+
+        :param paths: The changed paths in the mounted file system.
+        """
+        with self._lock:
+            inodes = [
+                (self._inodes.get(path), self._inodes.get(
+                    os.path.dirname(path)), os.path.basename(path))
+                for path in paths]
+
+        def notify():
+            for inode, parent_inode, name in inodes:
+                try:
+                    if inode is not None:
+                        pyfuse3.invalidate_inode(inode)
+                    if parent_inode is not None and name:
+                        pyfuse3.invalidate_entry_async(
+                            parent_inode,
+                            os.fsencode(name),
+                            ignore_enoent=True)
+                except OSError:
+                    pass
+
+        if any(inode is not None or parent is not None
+               for inode, parent, _ in inodes):
+            thread = threading.Thread(target=notify, name='photofs-notify')
+            thread.daemon = True
+            thread.start()
+
+
+def mount(operations, mountpoint, options=(), debug=False):
+    """Mounts a file system and serves requests until it is unmounted.
+
+    :param AsyncPhotoFS operations: The file system.
+
+    :param str mountpoint: The mount point.
+
+    :param options: Additional *FUSE* mount options.
+
+    :param bool debug: Whether to enable debug output of *FUSE*.
+    """
+    fuse_options = set(pyfuse3.default_options)
+    fuse_options.add('fsname=photofs')
+    fuse_options.update(options)
+    if debug:
+        fuse_options.add('debug')
+
+    pyfuse3.init(operations, mountpoint, fuse_options)
+    try:
+        trio.run(pyfuse3.main)
+    finally:
+        pyfuse3.close(unmount=True)
+        operations.destroy()
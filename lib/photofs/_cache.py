@@ -0,0 +1,404 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import threading
+import time
+
+try:
+    import pyinotify
+except ImportError:
+    pyinotify = None
+
+
+class AttributeCache(object):
+    """A cache of attribute records for file based images.
+
+    Records are keyed by the location of the image in the file system, and
+    are kept until they time out or are invalidated. Expired records are
+    removed at most once every timeout, when records are added.
+
+    The cache may be used from several threads; records are built outside of
+    the lock, so the same record may occasionally be built more than once.
+    """
+    def __init__(self, timeout):
+        """Creates an attribute cache.
+
+        :param float timeout: The number of seconds a record is valid. If this
+            is not positive, nothing is cached.
+        """
+        super(AttributeCache, self).__init__()
+        self._timeout = timeout
+        self._lock = threading.Lock()
+        self._records = {}
+        self._prune_time = 0
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def timeout(self):
+        """The number of seconds a record is valid."""
+        return self._timeout
+
+    @property
+    def hits(self):
+        """The number of lookups served from the cache."""
+        return self._hits
+
+    @property
+    def misses(self):
+        """The number of lookups that required a new record."""
+        return self._misses
+
+    def __len__(self):
+        return len(self._records)
+
+    def get(self, location, build):
+        """Returns the record for a location.
+
+        :param str location: The location of the image.
+
+        :param build: A callable returning a new record. This is called if no
+            valid record is cached.
+
+        :return: the record
+        """
+        if self._timeout <= 0:
+            return build()
+
+        now = time.time()
+        with self._lock:
+            expires, record = self._records.get(location, (0, None))
+            if expires > now:
+                self._hits += 1
+                return record
+            self._misses += 1
+
+        record = build()
+        with self._lock:
+            self._prune(now)
+            self._records[location] = (now + self._timeout, record)
+        return record
+
+    def get_all(self, locations, build):
+        """Returns the records for several locations.
+
+        :param [str] locations: The locations of the images.
+
+        :param build: A callable returning new records for a list of
+            locations, in the same order. This is called once with all
+            locations for which no valid record is cached. Records that are
+            ``None`` are returned, but not cached.
+
+        :return: the records, in the same order as ``locations``
+        :rtype: list
+        """
+        if self._timeout <= 0:
+            return build(locations)
+
+        now = time.time()
+        result = []
+        missing = []
+        with self._lock:
+            for i, location in enumerate(locations):
+                expires, record = self._records.get(location, (0, None))
+                if expires > now:
+                    result.append(record)
+                else:
+                    result.append(None)
+                    missing.append(i)
+            self._hits += len(locations) - len(missing)
+            self._misses += len(missing)
+
+        if missing:
+            records = build([locations[i] for i in missing])
+            with self._lock:
+                self._prune(now)
+                for i, record in zip(missing, records):
+                    result[i] = record
+                    if record is not None:
+                        self._records[locations[i]] = (
+                            now + self._timeout, record)
+
+        return result
+
+    def _prune(self, now):
+        """Removes all expired records, unless this was done less than one
+        timeout ago.
+
+        The lock must be held.
+
+        :param float now: The current time.
+        """
+        if now < self._prune_time:
+            return
+        self._prune_time = now + self._timeout
+        for location in [
+                location
+                for location, (expires, _) in self._records.items()
+                if expires <= now]:
+            del self._records[location]
+
+    def invalidate(self, location=None):
+        """Invalidates the record for a location.
+
+        :param location: The location to invalidate. If this is ``None``, all
+            records are invalidated.
+        :type location: str or None
+        """
+        with self._lock:
+            if location is None:
+                self._records.clear()
+            else:
+                self._records.pop(location, None)
+
+
+class PathCache(object):
+    """A bounded cache of resolved paths.
+
+    The cache is tied to the generation of a tree; when a lookup for a newer
+    generation is made, all entries are discarded. The least recently used
+    entry is discarded when the cache is full.
+    """
+    #: The value stored for paths that do not exist
+    MISSING = object()
+
+    def __init__(self, size):
+        """Creates a path cache.
+
+        :param int size: The maximum number of entries. If this is not
+            positive, nothing is cached.
+        """
+        super(PathCache, self).__init__()
+        self._size = size
+        self._entries = collections.OrderedDict()
+        self._generation = None
+        self._lock = threading.Lock()
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def size(self):
+        """The maximum number of entries."""
+        return self._size
+
+    @property
+    def hits(self):
+        """The number of lookups served from the cache."""
+        return self._hits
+
+    @property
+    def misses(self):
+        """The number of lookups that required resolving the path."""
+        return self._misses
+
+    def __len__(self):
+        return len(self._entries)
+
+    def get(self, generation, path, resolve):
+        """Returns the resolved value for a path.
+
+        :param int generation: The generation of the tree in which the path is
+            resolved.
+
+        :param str path: The path.
+
+        :param resolve: A callable resolving the path. This is called if the
+            path is not cached. If it raises :class:`KeyError`, the path is
+            cached as missing.
+
+        :return: the resolved value
+
+        :raises KeyError: if the path does not exist
+        """
+        if self._size <= 0:
+            return resolve()
+
+        with self._lock:
+            if generation != self._generation:
+                if self._generation is not None \
+                        and generation < self._generation:
+                    # Do not let readers of an old tree pollute the cache
+                    return resolve()
+                self._entries.clear()
+                self._generation = generation
+
+            try:
+                value = self._entries[path]
+                self._entries.move_to_end(path)
+                self._hits += 1
+            except KeyError:
+                value = None
+                self._misses += 1
+
+        if value is None:
+            try:
+                value = resolve()
+            except KeyError:
+                value = self.MISSING
+            with self._lock:
+                if generation == self._generation:
+                    self._entries[path] = value
+                    if len(self._entries) > self._size:
+                        self._entries.popitem(last=False)
+
+        if value is self.MISSING:
+            raise KeyError(path)
+        else:
+            return value
+
+
+class CachePolicy(object):
+    """Decides how long the kernel may cache entries and attributes, and when
+    it may keep cached file data when a file is opened.
+    """
+    def __init__(self, timeout, limit=None):
+        """Creates a cache policy.
+
+        :param float timeout: The number of seconds the kernel may cache
+            entries and attributes. If this is not positive, the default
+            policy of *FUSE* is used and cached file data is never kept.
+
+        :param limit: The maximum value for ``timeout`` when the kernel is not
+            notified of changes, or ``None`` if it is. If this is set, cached
+            file data is never kept, since the kernel cannot be told to drop
+            it.
+        :type limit: float or None
+        """
+        super(CachePolicy, self).__init__()
+        self._timeout = timeout if limit is None else min(timeout, limit)
+        self._keep_cache = limit is None
+        self._opened = {}
+        self._lock = threading.Lock()
+
+    @property
+    def enabled(self):
+        """Whether this policy adds any caching."""
+        return self._timeout > 0
+
+    @property
+    def timeout(self):
+        """The number of seconds the kernel may cache entries and
+        attributes."""
+        return self._timeout
+
+    def fuse_options(self):
+        """Returns the *FUSE* mount options implementing this policy.
+
+        :return: a mapping from option name to value
+        :rtype: dict
+        """
+        if not self.enabled:
+            return {}
+        return {
+            'attr_timeout': self._timeout,
+            'entry_timeout': self._timeout,
+            'negative_timeout': self._timeout}
+
+    def keep_cache(self, path, signature):
+        """Determines whether the kernel may keep cached data when a file is
+        opened.
+
+        Cached data is kept if the previous open of the same path had the same
+        signature, and the path has not been invalidated since.
+
+        :param str path: The path being opened.
+
+        :param signature: A value identifying the content of the file, for
+            example its location, modification time and size.
+
+        :return: whether to keep cached data
+        :rtype: bool
+        """
+        if not self.enabled or not self._keep_cache:
+            return False
+        with self._lock:
+            previous = self._opened.get(path)
+            self._opened[path] = signature
+        return previous == signature
+
+    def invalidate(self, paths):
+        """Invalidates paths that have changed.
+
+        :param paths: The paths of changed items.
+        """
+        with self._lock:
+            for path in paths:
+                self._opened.pop(path, None)
+
+
+class DirectoryWatcher(object):
+    """Watches directories for changes to the files they contain using
+    *inotify*.
+
+    This requires *pyinotify*.
+    """
+    #: The events that cause a file to be reported as changed
+    MASK = 0 if pyinotify is None else (
+        pyinotify.IN_ATTRIB |
+        pyinotify.IN_CLOSE_WRITE |
+        pyinotify.IN_DELETE |
+        pyinotify.IN_MODIFY |
+        pyinotify.IN_MOVED_FROM |
+        pyinotify.IN_MOVED_TO)
+
+    def __init__(self, callback):
+        """Creates a directory watcher.
+
+        Changes are not reported until :meth:`start` has been called.
+
+        :param callback: The callback to invoke with the full path of a file
+            when it changes.
+
+        :raises RuntimeError: if *pyinotify* is not available
+        """
+        if pyinotify is None:
+            raise RuntimeError('Watching directories requires pyinotify')
+        super(DirectoryWatcher, self).__init__()
+        self._directories = set()
+        self._lock = threading.Lock()
+        self._manager = pyinotify.WatchManager()
+        self._notifier = pyinotify.ThreadedNotifier(
+            self._manager,
+            lambda event: callback(event.pathname))
+        self._notifier.daemon = True
+
+    def start(self):
+        """Starts the background thread reporting changes.
+
+        Since threads do not survive a fork, this must be called once the
+        process has been daemonised.
+        """
+        self._notifier.start()
+
+    def watch(self, directories):
+        """Starts watching directories.
+
+        Directories already watched are ignored.
+
+        :param directories: The directories to watch.
+        """
+        with self._lock:
+            directories = set(directories) - self._directories
+            if directories:
+                self._manager.add_watch(list(directories), self.MASK)
+                self._directories.update(directories)
+
+    def stop(self):
+        """Stops the background thread."""
+        self._notifier.stop()
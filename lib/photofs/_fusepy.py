@@ -0,0 +1,52 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import fuse
+
+
+class FUSE(fuse.FUSE):
+    """The *fusepy* binding, passing the offset requested by the kernel to
+    ``readdir``.
+
+    The operations must implement ``readdir(path, fh, offset)``, and return an
+    iterable of tuples ``(name, attrs, next)``, where ``next`` is the non-zero
+    offset of the entry following ``name``. *FUSE* then requests each part of
+    a directory listing as the kernel needs it, instead of reading and
+    buffering the entire listing when the directory is first read.
+    """
+    def readdir(self, path, buf, filler, offset, fip):
+        # Like the base class, this ignores raw_fi
+        use_ns = getattr(self, 'use_ns', False)
+        for name, attrs, next_offset in self.operations(
+                'readdir',
+                path.decode(self.encoding) if path is not None else None,
+                fip.contents.fh,
+                offset):
+            if attrs:
+                st = fuse.c_stat()
+                if use_ns:
+                    fuse.set_st_attrs(st, attrs, use_ns=True)
+                else:
+                    fuse.set_st_attrs(st, attrs)
+            else:
+                st = None
+
+            if filler(buf, name.encode(self.encoding), st, next_offset) != 0:
+                break
+
+        return 0
@@ -0,0 +1,519 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import concurrent.futures
+import os
+import threading
+
+
+class Handle(object):
+    """An open image or video.
+
+    This is an abstract class.
+    """
+    def read_at(self, size, offset):
+        """Reads data at an offset.
+
+        This may be called concurrently from several threads.
+
+        :param int size: The maximum number of bytes to read.
+
+        :param int offset: The offset from which to read.
+
+        :return: the data read
+        :rtype: bytes
+        """
+        raise NotImplementedError()
+
+    def close(self):
+        """Closes this handle.
+        """
+        raise NotImplementedError()
+
+
+class StreamHandle(Handle):
+    """A handle wrapping a stream returned by :meth:`Image.open`.
+
+    Since the stream has a position, reads are serialised.
+    """
+    def __init__(self, stream):
+        """Wraps a stream.
+
+        :param stream: An object supporting ``tell()``, ``seek(offset)``,
+            ``read(size)`` and ``close()`` from :class:`file`.
+        """
+        super(StreamHandle, self).__init__()
+        self._stream = stream
+        self._lock = threading.Lock()
+
+    def read_at(self, size, offset):
+        with self._lock:
+            if self._stream.tell() != offset:
+                self._stream.seek(offset)
+            return self._stream.read(size)
+
+    def close(self):
+        with self._lock:
+            self._stream.close()
+
+
+class DescriptorHandle(Handle):
+    """A handle wrapping a raw file descriptor.
+
+    Reads use :func:`os.pread`, which does not use the file position, so no
+    locking is required.
+    """
+    def __init__(self, fd):
+        """Wraps a file descriptor.
+
+        :param int fd: The file descriptor. This is closed by :meth:`close`.
+        """
+        super(DescriptorHandle, self).__init__()
+        self._fd = fd
+
+    def read_at(self, size, offset):
+        return os.pread(self._fd, size, offset)
+
+    def close(self):
+        os.close(self._fd)
+
+
+class PooledHandle(Handle):
+    """A handle using a file descriptor shared through a
+    :class:`DescriptorPool`.
+    """
+    def __init__(self, pool, location, fd):
+        """Wraps a pooled file descriptor.
+
+        :param DescriptorPool pool: The pool from which the descriptor was
+            acquired.
+
+        :param str location: The location of the file.
+
+        :param int fd: The file descriptor. This is released to the pool by
+            :meth:`close`.
+        """
+        super(PooledHandle, self).__init__()
+        self._pool = pool
+        self._location = location
+        self._fd = fd
+
+    def read_at(self, size, offset):
+        return os.pread(self._fd, size, offset)
+
+    def close(self):
+        self._pool.release(self._location)
+
+
+class DescriptorPool(object):
+    """A bounded pool of read only file descriptors keyed by location.
+
+    Since reads use :func:`os.pread`, a descriptor can be shared by all handles
+    to the same file. Descriptors no longer used by any handle are kept open,
+    and the least recently used ones are closed when more than ``size`` are
+    unused.
+
+    Before an unused descriptor is reused, the file at the location is checked
+    to still be the same file; this is a single ``stat`` call instead of an
+    ``open`` and a ``close``.
+    """
+    def __init__(self, size):
+        """Creates a descriptor pool.
+
+        :param int size: The maximum number of unused descriptors to keep
+            open.
+        """
+        super(DescriptorPool, self).__init__()
+        self._size = size
+        self._lock = threading.Lock()
+
+        #: A mapping from location to the tuple ``[fd, identity, users]``
+        self._descriptors = {}
+
+        #: The locations of unused descriptors, least recently used first
+        self._unused = collections.OrderedDict()
+
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def size(self):
+        """The maximum number of unused descriptors to keep open."""
+        return self._size
+
+    @property
+    def hits(self):
+        """The number of handles opened using an already open descriptor."""
+        return self._hits
+
+    @property
+    def misses(self):
+        """The number of handles that required opening a file."""
+        return self._misses
+
+    def __len__(self):
+        return len(self._descriptors)
+
+    def open(self, location):
+        """Opens a handle to a file.
+
+        :param str location: The location of the file.
+
+        :return: a handle
+        :rtype: PooledHandle
+
+        :raises OSError: if the file cannot be opened
+        """
+        # The system calls are made without the lock held, since they may be
+        # slow for network file systems
+        with self._lock:
+            entry = self._descriptors.get(location)
+            if entry is not None and entry[2]:
+                return self._acquire(location, entry)
+            identity = entry[1] if entry is not None else None
+
+        if identity is not None:
+            # Make sure that the file has not been replaced
+            try:
+                st = os.stat(location)
+                valid = (st.st_dev, st.st_ino) == identity
+            except OSError:
+                valid = False
+            if valid:
+                with self._lock:
+                    entry = self._descriptors.get(location)
+                    if entry is not None and entry[1] == identity:
+                        return self._acquire(location, entry)
+
+        fd = os.open(location, os.O_RDONLY)
+        try:
+            st = os.fstat(fd)
+        except:
+            os.close(fd)
+            raise
+        identity = (st.st_dev, st.st_ino)
+
+        with self._lock:
+            entry = self._descriptors.get(location)
+            if entry is None or not (entry[2] or entry[1] == identity):
+                if entry is not None:
+                    self._close(location)
+                self._misses += 1
+                self._descriptors[location] = [fd, identity, 1]
+                return PooledHandle(self, location, fd)
+            handle = self._acquire(location, entry)
+
+        # Another thread opened the file at the same time
+        os.close(fd)
+        return handle
+
+    def _acquire(self, location, entry):
+        """Acquires an open descriptor.
+
+        The lock must be held.
+
+        :param str location: The location of the file.
+
+        :param list entry: The entry for ``location``.
+
+        :return: a handle
+        :rtype: PooledHandle
+        """
+        self._hits += 1
+        entry[2] += 1
+        self._unused.pop(location, None)
+        return PooledHandle(self, location, entry[0])
+
+    def release(self, location):
+        """Releases a descriptor acquired by :meth:`open`.
+
+        :param str location: The location of the file.
+        """
+        with self._lock:
+            entry = self._descriptors[location]
+            entry[2] -= 1
+            if entry[2]:
+                return
+
+            self._unused[location] = True
+            while len(self._unused) > self._size:
+                self._close(next(iter(self._unused)))
+
+    def clear(self):
+        """Closes all unused descriptors.
+        """
+        with self._lock:
+            for location in list(self._unused):
+                self._close(location)
+
+    def _close(self, location):
+        """Closes the unused descriptor for a location.
+
+        The lock must be held.
+
+        :param str location: The location of the file.
+        """
+        self._unused.pop(location, None)
+        fd, identity, users = self._descriptors.pop(location)
+        os.close(fd)
+
+
+class ReadAhead(object):
+    """Prefetches data for handles being read sequentially.
+
+    All handles wrapped by a read-ahead share a bounded thread pool and a
+    memory budget; when the budget is exhausted, no more data is prefetched
+    until buffered data has been consumed.
+    """
+    def __init__(
+            self,
+            memory,
+            minimum=128 * 1024,
+            maximum=4 * 1024 * 1024,
+            threshold=2,
+            workers=4):
+        """Creates a read-ahead.
+
+        :param int memory: The maximum number of bytes buffered for all
+            handles.
+
+        :param int minimum: The initial read-ahead window, in bytes.
+
+        :param int maximum: The maximum read-ahead window, in bytes. The
+            window doubles for every prefetch as long as reads are sequential.
+
+        :param int threshold: The number of sequential reads required before
+            prefetching starts.
+
+        :param int workers: The number of threads performing prefetches.
+        """
+        super(ReadAhead, self).__init__()
+        self._memory = memory
+        self._used = 0
+        self._lock = threading.Lock()
+        self.minimum = minimum
+        self.maximum = maximum
+        self.threshold = threshold
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self._hits = 0
+        self._misses = 0
+
+    @property
+    def memory(self):
+        """The maximum number of bytes buffered for all handles."""
+        return self._memory
+
+    @property
+    def used(self):
+        """The number of bytes currently reserved for buffers."""
+        return self._used
+
+    @property
+    def hits(self):
+        """The number of reads served from prefetched data."""
+        return self._hits
+
+    @property
+    def misses(self):
+        """The number of reads passed on to the wrapped handles."""
+        return self._misses
+
+    def wrap(self, handle):
+        """Wraps a handle to prefetch data when read sequentially.
+
+        :param Handle handle: The handle to wrap.
+
+        :return: a wrapping handle
+        :rtype: ReadAheadHandle
+        """
+        return ReadAheadHandle(self, handle)
+
+    def shutdown(self):
+        """Stops the prefetching threads.
+        """
+        self._executor.shutdown()
+
+    def _reserve(self, size):
+        """Reserves memory for a buffer.
+
+        :param int size: The number of bytes to reserve.
+
+        :return: whether the memory was reserved
+        :rtype: bool
+        """
+        with self._lock:
+            if self._used + size > self._memory:
+                return False
+            self._used += size
+            return True
+
+    def _free(self, size):
+        """Frees memory reserved by :meth:`_reserve`.
+
+        :param int size: The number of bytes to free.
+        """
+        with self._lock:
+            self._used -= size
+
+    def _count(self, hit):
+        """Counts a read.
+
+        :param bool hit: Whether the read was served from prefetched data.
+        """
+        with self._lock:
+            if hit:
+                self._hits += 1
+            else:
+                self._misses += 1
+
+    def _submit(self, handle, size, offset):
+        """Schedules a read from a handle.
+
+        :param Handle handle: The handle from which to read.
+
+        :param int size: The number of bytes to read.
+
+        :param int offset: The offset from which to read.
+
+        :return: a future for the data
+        """
+        return self._executor.submit(handle.read_at, size, offset)
+
+
+class ReadAheadHandle(Handle):
+    """A handle prefetching data from a wrapped handle when it is read
+    sequentially.
+
+    Random access is passed on to the wrapped handle directly.
+    """
+    def __init__(self, read_ahead, handle):
+        """Wraps a handle.
+
+        :param ReadAhead read_ahead: The read-ahead providing threads and
+            memory.
+
+        :param Handle handle: The handle to wrap. This is closed by
+            :meth:`close`.
+        """
+        super(ReadAheadHandle, self).__init__()
+        self._read_ahead = read_ahead
+        self._handle = handle
+        self._lock = threading.Lock()
+
+        # The offset of the next read if reading sequentially, the number of
+        # sequential reads and the current window
+        self._next = 0
+        self._sequential = 0
+        self._window = read_ahead.minimum
+
+        #: The prefetched chunks as the tuples ``(offset, size, future)``,
+        #: ordered by offset
+        self._chunks = collections.deque()
+
+    def read_at(self, size, offset):
+        read_ahead = self._read_ahead
+        with self._lock:
+            if offset == self._next:
+                self._sequential += 1
+            else:
+                self._sequential = 0
+                self._window = read_ahead.minimum
+                self._discard(len(self._chunks))
+            self._next = offset + size
+
+            # Drop chunks that have been consumed, and find the one covering
+            # this read, if any
+            while self._chunks and \
+                    self._chunks[0][0] + self._chunks[0][1] <= offset:
+                self._discard(1)
+            future = None
+            if self._chunks:
+                start, length, chunk = self._chunks[0]
+                if start <= offset and offset + size <= start + length:
+                    future = chunk
+
+            if self._sequential >= read_ahead.threshold:
+                self._prefetch(offset + size)
+
+        if future is not None:
+            try:
+                data = future.result()
+                read_ahead._count(True)
+                return data[offset - start:offset - start + size]
+            except Exception:
+                # Let the direct read report any error
+                pass
+
+        read_ahead._count(False)
+        return self._handle.read_at(size, offset)
+
+    def close(self):
+        with self._lock:
+            futures = self._discard(len(self._chunks))
+
+        # The wrapped handle must not be closed while it is being read
+        concurrent.futures.wait(futures)
+        self._handle.close()
+
+    def _prefetch(self, position):
+        """Schedules prefetching of the window following a position unless it
+        is already buffered.
+
+        The lock must be held.
+
+        :param int position: The offset following the last read.
+        """
+        if self._chunks:
+            start, length, future = self._chunks[-1]
+            end = start + length
+        else:
+            end = position
+        if end - position >= self._window:
+            return
+
+        size = self._window
+        if not self._read_ahead._reserve(size):
+            return
+        self._chunks.append((
+            end,
+            size,
+            self._read_ahead._submit(self._handle, size, end)))
+        self._window = min(self._window * 2, self._read_ahead.maximum)
+
+    def _discard(self, count):
+        """Discards the first chunks.
+
+        Reads in progress are not waited for; the memory of a chunk is freed
+        once its read has finished.
+
+        The lock must be held.
+
+        :param int count: The number of chunks to discard.
+
+        :return: the futures of the discarded chunks
+        """
+        futures = []
+        for _ in range(count):
+            start, length, future = self._chunks.popleft()
+            future.cancel()
+            future.add_done_callback(
+                lambda future, length=length: self._read_ahead._free(length))
+            futures.append(future)
+
+        return futures
@@ -19,12 +19,49 @@
 import datetime
 import mimetypes
 import os
+import sys
 import time
 
+from ._handle import DescriptorHandle, StreamHandle
+
+
+#: A mapping from file extension to whether the extension denotes a video
+_VIDEO_EXTENSIONS = {}
+
+
+def is_video_extension(extension):
+    """Determines whether a file extension denotes a video from its *MIME
+    type*.
+
+    The result is cached for every extension.
+
+    :param str extension: The file extension, without a dot.
+
+    :return: whether the extension denotes a video
+    :rtype: bool
+    """
+    try:
+        return _VIDEO_EXTENSIONS[extension]
+    except KeyError:
+        mime, encoding = mimetypes.guess_type('file.' + extension)
+        result = _VIDEO_EXTENSIONS[extension] = bool(
+            mime and mime.startswith('video/'))
+        return result
+
 
 class Image(object):
     """An image or video.
+
+    Since a library may contain millions of images, instances are kept small:
+    they have no instance ``dict``, timestamps are stored as numbers and
+    extensions are interned.
     """
+    __slots__ = (
+        '_title',
+        '_extension',
+        '_timestamp',
+        '_stat',
+        '_is_video')
 
     #: The date format used to construct the title when none is set
     DATE_FORMAT = '%Y-%m-%d, %H.%M'
@@ -50,29 +87,46 @@ class Image(object):
         """
         super(Image, self).__init__()
         self._title = title
-        self._extension = extension
+        self._extension = sys.intern(extension)
         if isinstance(timestamp, datetime.datetime):
-            self._timestamp = timestamp
+            self._timestamp = time.mktime(timestamp.timetuple()) \
+                + timestamp.microsecond / 1000000.0
         else:
-            self._timestamp = datetime.datetime.fromtimestamp(timestamp)
+            self._timestamp = float(timestamp)
         if is_video is None:
-            mime, encoding = mimetypes.guess_type('file.' + extension)
-            is_video = mime and mime.startswith('video/')
+            is_video = is_video_extension(extension)
         self._stat = st
-        self._is_video = is_video
+        self._is_video = bool(is_video)
+
+    @classmethod
+    def format_timestamp(self, timestamp):
+        """Formats a timestamp using :attr:`DATE_FORMAT`.
+
+        This is the title used for images without a title.
+
+        :param float timestamp: The timestamp, in seconds since the epoch.
+
+        :return: the formatted timestamp
+        :rtype: str
+        """
+        return time.strftime(self.DATE_FORMAT, time.localtime(timestamp))
 
     @property
     def timestamp(self):
         """The timestamp when this image or video was created."""
+        return datetime.datetime.fromtimestamp(self._timestamp)
+
+    @property
+    def posix_timestamp(self):
+        """The timestamp when this image or video was created, in seconds since
+        the epoch."""
         return self._timestamp
 
     @property
     def title(self):
         """The title of this image. Use this to generate the file name if it is
         set."""
-        return self._title or time.strftime(
-            self.DATE_FORMAT,
-            self.timestamp.timetuple())
+        return self._title or self.format_timestamp(self._timestamp)
 
     @property
     def extension(self):
@@ -99,11 +153,29 @@ class Image(object):
         """
         raise NotImplementedError()
 
+    def open_handle(self, flags):
+        """Opens a handle supporting concurrent reads at arbitrary offsets.
+
+        The default implementation wraps the stream returned by :meth:`open`.
+
+        :param int flags: Flags passed by *FUSE*.
+
+        :return: a handle
+        :rtype: photofs._handle.Handle
+        """
+        return StreamHandle(self.open(flags))
+
 
 class FileBasedImage(Image):
     """An image or video.
+
+    The ``stat`` value is read from the file system when requested, so it is
+    not kept.
     """
-    def __init__(self, title, location, timestamp, is_video=None):
+    __slots__ = (
+        '_location',)
+
+    def __init__(self, title, location, timestamp, is_video=None, st=None):
         """Initialises a file based image.
 
         :param str title: The title of the image. This should be used to
@@ -119,13 +191,20 @@ class FileBasedImage(Image):
         :param bool is_video: Whether this image is a video. This must be
             either ``True`` or ``False``, or ``None``. If it is ``None``, the
             type is inferred from the file *MIME type*.
+
+        :param os.stat_result st: The ``lstat`` value of ``location``, if it
+            has already been read.
+
+        :raises OSError: if ``st`` is not provided and ``location`` cannot be
+            read
         """
         super(FileBasedImage, self).__init__(
             title,
             location.rsplit('.', 1)[-1].lower(),
             timestamp,
-            os.lstat(location),
+            st if st is not None else os.lstat(location),
             is_video)
+        self._stat = None
         self._location = location
 
     @property
@@ -140,3 +219,9 @@ class FileBasedImage(Image):
 
     def open(self, flags):
         return open(self.location, 'rb')
+
+    def open_handle(self, flags):
+        if hasattr(os, 'pread'):
+            return DescriptorHandle(os.open(self.location, os.O_RDONLY))
+        else:
+            return super(FileBasedImage, self).open_handle(flags)
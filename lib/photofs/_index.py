@@ -0,0 +1,205 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+from ._image import Image
+from ._tag import Tag
+
+
+class FilterIndex(object):
+    """The result of applying a filter to all images of an image source.
+
+    The filter is applied once to every image, and the number of included
+    images beneath every tag is counted, so checking whether an item is
+    included is a constant time operation.
+
+    The index is only valid for the tree from which it was created.
+    """
+    def __init__(self, root, include):
+        """Creates an index by applying a filter to all images beneath a root.
+
+        :param dict root: The root of the tree to index; this is typically a
+            :class:`Tree`.
+
+        :param include: The filter function. This is passed an image and
+            should return whether to include it. If this is ``None``, all
+            images are included.
+        """
+        super(FilterIndex, self).__init__()
+        self._include = include or (lambda image: True)
+
+        #: A mapping from item ID to the number of included images
+        self._counts = {}
+
+        #: A mapping from tag ID to the names of included items
+        self._listings = {}
+
+        self._count(root)
+
+    def _count(self, tag):
+        """Counts the number of included images beneath a tag.
+
+        :param dict tag: The tag to count.
+
+        :return: the number of included images
+        :rtype: int
+        """
+        counts = self._counts
+        count = 0
+        for item in tag.values():
+            if isinstance(item, Tag):
+                count += self._count(item)
+            elif isinstance(item, Image):
+                # Images may be present in several tags, but only need to be
+                # filtered once
+                included = counts.get(id(item))
+                if included is None:
+                    included = counts[id(item)] = 1 if self._include(item) \
+                        else 0
+                count += included
+        counts[id(tag)] = count
+
+        return count
+
+    def count(self, item):
+        """Returns the number of included images beneath an item.
+
+        :param item: The tag or image.
+        :type item: Image or Tag
+
+        :return: the number of included images, which is ``0`` or ``1`` for
+            images
+        :rtype: int
+        """
+        return self._counts.get(id(item), 0)
+
+    def includes(self, item):
+        """Returns whether an item is included.
+
+        A tag is included if it contains at least one included image.
+
+        :param item: The tag or image.
+        :type item: Image or Tag
+
+        :return: whether the item is included
+        :rtype: bool
+        """
+        return self._counts.get(id(item), 0) > 0
+
+    def listing(self, tag):
+        """Returns the names of all included items in a tag.
+
+        The listing is cached.
+
+        :param dict tag: The tag to list.
+
+        :return: the names of all included items
+        :rtype: [str]
+        """
+        try:
+            return self._listings[id(tag)]
+        except KeyError:
+            counts = self._counts
+            result = self._listings[id(tag)] = [
+                k
+                for k, v in tag.items()
+                if counts.get(id(v), 0) > 0]
+            return result
+
+
+class Cursor(object):
+    """A position in the listing of a directory.
+
+    The entries of the listing are read a page at a time, so listing a large
+    directory only requires memory for one page in addition to the names,
+    which are typically shared with a :class:`FilterIndex`. The offset of an
+    entry is its position in the listing, so offsets remain valid for as long
+    as the cursor is used.
+    """
+    #: The maximum number of entries read at a time
+    PAGE_SIZE = 128
+
+    def __init__(self, names, read):
+        """Creates a cursor.
+
+        :param [str] names: The names of all entries, in the order in which
+            they are listed. This must not be modified.
+
+        :param read: A callable returning the entries for a list of names as a
+            list of tuples ``(name, attrs)``.
+        """
+        super(Cursor, self).__init__()
+        self._names = names
+        self._read = read
+
+        #: The offset of the current page, and its entries
+        self._page = (0, [])
+
+    def __len__(self):
+        return len(self._names)
+
+    def cached(self, offset):
+        """Returns whether the entry at an offset can be listed without
+        reading a new page.
+
+        :param int offset: The offset.
+
+        :return: whether the entry has been read, or ``offset`` is past the
+            end of the listing
+        :rtype: bool
+        """
+        start, entries = self._page
+        return start <= offset < start + len(entries) \
+            or offset >= len(self._names)
+
+    def entries(self, offset=0):
+        """Lists the entries following an offset.
+
+        The page containing the first entry is read immediately; any following
+        pages are read when the iteration reaches them.
+
+        :param int offset: The offset of the first entry to list.
+
+        :return: an iterator over tuples ``(name, attrs, next)``, where
+            ``next`` is the offset of the following entry
+        """
+        self._seek(offset)
+        return self._iterate(offset)
+
+    def _seek(self, offset):
+        """Makes the page containing an offset current.
+
+        :param int offset: The offset.
+
+        :return: the tuple ``(start, entries)`` for the page
+        """
+        if not self.cached(offset):
+            self._page = (
+                offset,
+                self._read(self._names[offset:offset + self.PAGE_SIZE]))
+        return self._page
+
+    def _iterate(self, offset):
+        """Yields the entries following an offset.
+
+        See :meth:`entries` for a description of the parameters.
+        """
+        while offset < len(self._names):
+            start, entries = self._seek(offset)
+            for name, attrs in entries[offset - start:]:
+                offset += 1
+                yield (name, attrs, offset)
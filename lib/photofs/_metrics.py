@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import io
+import os
+import stat
+import threading
+import time
+
+from ._handle import StreamHandle
+from ._image import Image
+
+
+class Histogram(object):
+    """A histogram of durations with fixed buckets.
+    """
+    #: The default upper bounds of the buckets, in seconds
+    BUCKETS = (
+        0.0001, 0.00025, 0.0005,
+        0.001, 0.0025, 0.005,
+        0.01, 0.025, 0.05,
+        0.1, 0.25, 0.5,
+        1.0, 2.5, 5.0, 10.0)
+
+    def __init__(self, buckets=BUCKETS):
+        """Creates an empty histogram.
+
+        :param buckets: The sorted upper bounds of the buckets. A bucket for
+            values greater than the last bound is added.
+        """
+        self._buckets = tuple(buckets)
+        self._counts = [0] * (len(self._buckets) + 1)
+        self._sum = 0.0
+
+    @property
+    def count(self):
+        """The number of observed values."""
+        return sum(self._counts)
+
+    @property
+    def sum(self):
+        """The sum of all observed values."""
+        return self._sum
+
+    def observe(self, value):
+        """Adds a value to this histogram.
+
+        This method is not synchronised.
+
+        :param float value: The value to add.
+        """
+        self._counts[bisect.bisect_left(self._buckets, value)] += 1
+        self._sum += value
+
+    def cumulative(self):
+        """Yields the cumulative counts of all buckets.
+
+        :return: a generator of tuples ``(bound, count)``, where ``bound`` is
+            the formatted upper bound of the bucket, ending with ``'+Inf'``
+        """
+        total = 0
+        for bound, count in zip(
+                tuple('%g' % b for b in self._buckets) + ('+Inf',),
+                self._counts):
+            total += count
+            yield bound, total
+
+
+class Metrics(object):
+    """Collects metrics and renders them in the *Prometheus* text format.
+
+    Durations and errors of operations are recorded by :meth:`observe`; all
+    other values are provided by collectors when the metrics are rendered.
+    """
+    #: The prefix of all metric names
+    PREFIX = 'photofs_'
+
+    def __init__(self, operations):
+        """Creates a metrics collection.
+
+        :param operations: The names of the operations for which to record
+            durations. Other operations passed to :meth:`observe` are ignored.
+        """
+        self._lock = threading.Lock()
+        self._durations = dict(
+            (operation, Histogram())
+            for operation in operations)
+        self._errors = dict.fromkeys(operations, 0)
+        self._collectors = []
+
+    def __contains__(self, operation):
+        return operation in self._durations
+
+    def observe(self, operation, duration, error=False):
+        """Records the duration of an operation.
+
+        :param str operation: The name of the operation.
+
+        :param float duration: The duration of the operation, in seconds.
+
+        :param bool error: Whether the operation failed.
+        """
+        histogram = self._durations.get(operation)
+        if histogram is None:
+            return
+        with self._lock:
+            histogram.observe(duration)
+            if error:
+                self._errors[operation] += 1
+
+    def add_collector(self, collector):
+        """Registers a collector of metrics.
+
+        :param collector: A callable returning an iterable of tuples ``(name,
+            type, help, samples)``, where ``name`` is the metric name without
+            :attr:`PREFIX`, ``type`` is ``'counter'`` or ``'gauge'`` and
+            ``samples`` is a sequence of tuples ``(labels, value)``, where
+            ``labels`` is a ``dict``.
+        """
+        self._collectors.append(collector)
+
+    def render(self):
+        """Renders all metrics.
+
+        :return: the metrics in the *Prometheus* text format
+        :rtype: str
+        """
+        lines = []
+
+        def family(name, kind, description):
+            lines.append('# HELP %s%s %s' % (self.PREFIX, name, description))
+            lines.append('# TYPE %s%s %s' % (self.PREFIX, name, kind))
+
+        def sample(name, labels, value):
+            lines.append('%s%s%s %s' % (
+                self.PREFIX,
+                name,
+                '{%s}' % ','.join(
+                    '%s="%s"' % (k, str(v)
+                                 .replace('\\', '\\\\')
+                                 .replace('"', '\\"')
+                                 .replace('\n', '\\n'))
+                    for k, v in sorted(labels.items()))
+                if labels else '',
+                repr(float(value)) if isinstance(value, float) else value))
+
+        with self._lock:
+            family(
+                'operation_duration_seconds',
+                'histogram',
+                'The duration of file system operations.')
+            for operation, histogram in sorted(self._durations.items()):
+                labels = {'operation': operation}
+                for bound, count in histogram.cumulative():
+                    sample(
+                        'operation_duration_seconds_bucket',
+                        dict(labels, le=bound),
+                        count)
+                sample(
+                    'operation_duration_seconds_sum', labels, histogram.sum)
+                sample(
+                    'operation_duration_seconds_count', labels,
+                    histogram.count)
+
+            family(
+                'operation_errors_total',
+                'counter',
+                'The number of failed file system operations.')
+            for operation, count in sorted(self._errors.items()):
+                sample(
+                    'operation_errors_total', {'operation': operation}, count)
+
+        for collector in self._collectors:
+            for name, kind, description, samples in collector():
+                family(name, kind, description)
+                for labels, value in samples:
+                    sample(name, labels, value)
+
+        return '\n'.join(lines) + '\n'
+
+
+class MetricsFile(Image):
+    """A virtual file containing the current metrics.
+
+    The content is rendered when the file is opened, so its size is not known
+    in advance; the file is reported as empty, and must be read using direct
+    I/O.
+    """
+    __slots__ = (
+        '_metrics',
+        '_st')
+
+    def __init__(self, name, metrics, st):
+        """Creates a metrics file.
+
+        :param str name: The file name.
+
+        :param Metrics metrics: The metrics to render.
+
+        :param os.stat_result st: The ``stat`` value of a directory whose
+            ownership and timestamps to use.
+        """
+        title, extension = os.path.splitext(name)
+        super(MetricsFile, self).__init__(
+            title,
+            extension[1:],
+            st.st_mtime,
+            None,
+            False)
+        self._metrics = metrics
+        self._st = st
+
+    @property
+    def stat(self):
+        """A ``stat`` result for an empty, read only regular file modified
+        now."""
+        now = time.time()
+        return os.stat_result((
+            stat.S_IFREG | stat.S_IRUSR | stat.S_IRGRP | stat.S_IROTH,
+            0,
+            self._st.st_dev,
+            1,
+            self._st.st_uid,
+            self._st.st_gid,
+            0,
+            now,
+            now,
+            now))
+
+    def open(self, flags):
+        return io.BytesIO(self._metrics.render().encode('utf-8'))
+
+    def open_handle(self, flags):
+        return StreamHandle(self.open(flags))
@@ -0,0 +1,372 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import concurrent.futures
+import errno
+import hashlib
+import os
+import threading
+
+try:
+    import PIL.Image
+    import PIL.ImageOps
+except ImportError:
+    PIL = None
+
+from ._handle import DescriptorHandle
+from ._image import Image, FileBasedImage
+
+
+#: A mapping from file extension to the format of the files as read by
+#: *Pillow*; this is populated when first used
+_READABLE = None
+
+
+def _source_format(extension):
+    """Determines the format of files with an extension.
+
+    :param str extension: The lower case file extension, without a dot.
+
+    :return: the format name used by *Pillow*, or ``None`` if *Pillow* cannot
+        read the files
+    :rtype: str or None
+    """
+    global _READABLE
+    if _READABLE is None:
+        if PIL is None:
+            return None
+        _READABLE = dict(
+            (ext[1:].lower(), format)
+            for ext, format in PIL.Image.registered_extensions().items()
+            if format in PIL.Image.OPEN)
+    return _READABLE.get(extension)
+
+
+def is_previewable(image):
+    """Determines whether a preview can be generated for an image.
+
+    :param Image image: The image.
+
+    :return: whether a preview can be generated
+    :rtype: bool
+    """
+    return isinstance(image, FileBasedImage) and not image.is_video \
+        and _source_format(image.extension) is not None
+
+
+def preview_name(name, image):
+    """Returns the name of the preview of an image.
+
+    If the rendition is stored in another format than the original, the
+    extension of that format is appended to the name of the original.
+
+    :param str name: The name of the original.
+
+    :param FileBasedImage image: The original image.
+
+    :return: the name of the preview
+    :rtype: str
+    """
+    extension = PreviewCache.format(image)[1]
+    return name if extension == image.extension \
+        else '%s.%s' % (name, extension)
+
+
+class PreviewFilter(object):
+    """A filter including only images for which previews can be generated and
+    that are included by another filter.
+    """
+    def __init__(self, include):
+        """Creates a preview filter.
+
+        :param include: The filter to combine with, or ``None`` to include all
+            previewable images.
+        """
+        super(PreviewFilter, self).__init__()
+        self.include = include
+
+    def __call__(self, image):
+        return is_previewable(image) and (
+            self.include is None or self.include(image))
+
+
+class PreviewCache(object):
+    """A size bounded cache of downscaled renditions of file based images,
+    stored in a directory.
+
+    Renditions are keyed by the location, modification time and size of the
+    original, and by the maximum dimension of the rendition, so modified
+    originals get new renditions. They are generated by a bounded thread pool,
+    and the least recently used ones are removed when the total size exceeds
+    the limit.
+
+    This requires *Pillow*.
+    """
+    #: The formats in which renditions may be stored; images in other formats
+    #: are stored as JPEG
+    FORMATS = ('JPEG', 'PNG', 'GIF', 'WEBP')
+
+    def __init__(self, directory, dimension, limit, workers=2):
+        """Creates a preview cache.
+
+        :param str directory: The directory in which to store renditions. This
+            is created if it does not exist.
+
+        :param int dimension: The maximum width and height of renditions.
+
+        :param int limit: The maximum total size of all renditions, in bytes.
+
+        :param int workers: The number of threads generating renditions.
+
+        :raises RuntimeError: if *Pillow* is not available
+        """
+        if PIL is None:
+            raise RuntimeError('Previews require Pillow')
+        super(PreviewCache, self).__init__()
+        self._directory = directory
+        self._dimension = dimension
+        self._limit = limit
+        self._lock = threading.Lock()
+        self._executor = concurrent.futures.ThreadPoolExecutor(workers)
+        self._pending = {}
+
+        # Load the existing renditions, least recently modified first
+        if not os.path.isdir(directory):
+            os.makedirs(directory)
+        entries = []
+        for name in os.listdir(directory):
+            try:
+                st = os.stat(os.path.join(directory, name))
+                entries.append((st.st_mtime, name, st.st_size))
+            except OSError:
+                pass
+        self._entries = collections.OrderedDict(
+            (name, size)
+            for mtime, name, size in sorted(entries))
+        self._total = sum(self._entries.values())
+
+    @property
+    def directory(self):
+        """The directory in which renditions are stored."""
+        return self._directory
+
+    @property
+    def total(self):
+        """The total size of all renditions, in bytes."""
+        return self._total
+
+    @classmethod
+    def format(self, image):
+        """Determines the format in which the rendition of an image is stored.
+
+        :param FileBasedImage image: The original image.
+
+        :return: the tuple ``(format, extension)``, where ``format`` is the
+            name used by *Pillow* and ``extension`` the lower case file
+            extension of the rendition
+        """
+        format = _source_format(image.extension)
+        if format in self.FORMATS:
+            return (format, image.extension)
+        else:
+            return ('JPEG', 'jpg')
+
+    def _name(self, image):
+        """Returns the file name of the rendition of an image.
+
+        :param FileBasedImage image: The original image.
+
+        :return: the file name
+        :rtype: str
+
+        :raises OSError: if the original cannot be read
+        """
+        st = image.stat
+        return hashlib.sha1((u'%s\0%s\0%d\0%d' % (
+            image.location,
+            st.st_mtime,
+            st.st_size,
+            self._dimension)).encode('utf-8')).hexdigest()
+
+    def find(self, image):
+        """Returns the location of the rendition of an image if it has
+        already been generated.
+
+        :param FileBasedImage image: The original image.
+
+        :return: the location of the rendition, or ``None``
+        :rtype: str or None
+
+        :raises OSError: if the original cannot be read
+        """
+        name = self._name(image)
+        with self._lock:
+            if name in self._entries:
+                return os.path.join(self._directory, name)
+
+    def request(self, image):
+        """Requests the rendition of an image.
+
+        :param FileBasedImage image: The original image.
+
+        :return: a future for the location of the rendition
+
+        :raises OSError: if the original cannot be read
+        """
+        name = self._name(image)
+        with self._lock:
+            if name in self._entries:
+                self._entries.move_to_end(name)
+                future = concurrent.futures.Future()
+                future.set_result(os.path.join(self._directory, name))
+                return future
+
+            try:
+                return self._pending[name]
+            except KeyError:
+                future = self._pending[name] = self._executor.submit(
+                    self._render, image, name)
+                return future
+
+    def get(self, image):
+        """Returns the location of the rendition of an image, generating it
+        if necessary.
+
+        :param FileBasedImage image: The original image.
+
+        :return: the location of the rendition
+        :rtype: str
+
+        :raises OSError: if the rendition cannot be generated
+        """
+        return self.request(image).result()
+
+    def shutdown(self):
+        """Stops the threads generating renditions.
+        """
+        self._executor.shutdown()
+
+    def _render(self, image, name):
+        """Generates a rendition and adds it to the cache.
+
+        :param FileBasedImage image: The original image.
+
+        :param str name: The file name of the rendition.
+
+        :return: the location of the rendition
+        :rtype: str
+
+        :raises OSError: if the rendition cannot be generated
+        """
+        format, extension = self.format(image)
+        target = os.path.join(self._directory, name)
+        temporary = '%s.%d' % (target, threading.current_thread().ident)
+        try:
+            source = PIL.Image.open(image.location)
+            try:
+                rendition = PIL.ImageOps.exif_transpose(source)
+                rendition.thumbnail((self._dimension, self._dimension))
+                if format == 'JPEG' and rendition.mode not in ('RGB', 'L'):
+                    rendition = rendition.convert('RGB')
+                rendition.save(temporary, format)
+            finally:
+                source.close()
+            os.rename(temporary, target)
+            size = os.stat(target).st_size
+
+        except Exception as e:
+            with self._lock:
+                self._pending.pop(name, None)
+            try:
+                os.unlink(temporary)
+            except OSError:
+                pass
+            raise OSError(
+                errno.EIO,
+                'Failed to generate preview for %s: %s' % (
+                    image.location, e))
+
+        with self._lock:
+            self._pending.pop(name, None)
+            self._entries[name] = size
+            self._total += size
+            while self._total > self._limit and len(self._entries) > 1:
+                evicted, evicted_size = self._entries.popitem(last=False)
+                self._total -= evicted_size
+                try:
+                    os.unlink(os.path.join(self._directory, evicted))
+                except OSError:
+                    pass
+
+        return target
+
+
+class Preview(Image):
+    """A downscaled rendition of a file based image.
+    """
+    __slots__ = (
+        '_image',
+        '_cache')
+
+    def __init__(self, image, cache):
+        """Creates a preview of an image.
+
+        :param FileBasedImage image: The original image.
+
+        :param PreviewCache cache: The cache providing the rendition.
+        """
+        super(Preview, self).__init__(
+            image.title,
+            cache.format(image)[1],
+            image.timestamp,
+            None,
+            image.is_video)
+        self._image = image
+        self._cache = cache
+
+    @property
+    def image(self):
+        """The original image."""
+        return self._image
+
+    @property
+    def stat(self):
+        """The ``stat`` result for the rendition.
+
+        If the rendition has not been generated yet, this does not wait for
+        it; its generation is started, and the ``stat`` result of the original
+        is returned instead. Since the size may thus be wrong, previews must be
+        read using direct I/O.
+        """
+        location = self._cache.find(self._image)
+        if location is not None:
+            try:
+                return os.lstat(location)
+            except OSError:
+                # The rendition has just been evicted
+                pass
+        self._cache.request(self._image)
+        return self._image.stat
+
+    def open(self, flags):
+        return open(self._cache.get(self._image), 'rb')
+
+    def open_handle(self, flags):
+        return DescriptorHandle(
+            os.open(self._cache.get(self._image), os.O_RDONLY))
@@ -16,16 +16,142 @@
 # You should have received a copy of the GNU General Public License along with
 # this program. If not, see <http://www.gnu.org/licenses/>.
 
+import concurrent.futures
+import hashlib
+import logging
 import os
+import pickle
+import threading
+import time
 
+from xdg.BaseDirectory import xdg_cache_home
+
+from ._image import Image
+from ._trace import Tracer, phase
 from ._util import make_unique
 from ._tag import Tag
 
 
-class ImageSource(dict):
+def _required(placement):
+    """Lists the tags required by a placement.
+
+    :param dict placement: A mapping from absolute tag path to images.
+
+    :return: the paths of all tags in ``placement`` and of their ancestors
+    :rtype: set(str)
+    """
+    result = set()
+    for path in placement:
+        while path and path not in result:
+            result.add(path)
+            path = path.rsplit(os.path.sep, 1)[0]
+
+    return result
+
+
+class Tree(dict):
+    """The root of a tree of tags, mapping the names of root tags to tags.
+
+    A tree is never modified once it has been published by an image source;
+    changes are made to a copy that replaces the published tree. Tags that do
+    not change are shared between the trees.
+    """
+    def __init__(self, generation=0):
+        """Creates an empty tree.
+
+        :param int generation: The generation of the tree.
+        """
+        super(Tree, self).__init__()
+        self._generation = generation
+
+        #: The images that have no tags, if the image source loads them
+        self.untagged = ()
+
+    @property
+    def generation(self):
+        """The generation of this tree.
+
+        This is incremented every time a new tree is published.
+        """
+        return self._generation
+
+    def copy(self, generation):
+        """Creates a copy of this tree.
+
+        Tags are not copied; a tag must be copied before it is modified, see
+        :meth:`ImageSource._update_tags`.
+
+        :param int generation: The generation of the copy.
+
+        :return: a copy of this tree
+        :rtype: Tree
+        """
+        result = Tree(generation)
+        result.update(self)
+        result.untagged = self.untagged
+        return result
+
+    def images(self):
+        """Lists all distinct images of this tree, including those that have
+        no tags.
+
+        :return: the images, in the order in which they are first found
+        :rtype: [Image]
+        """
+        images = {}
+        stack = [self]
+        while stack:
+            for item in stack.pop().values():
+                if isinstance(item, Tag):
+                    stack.append(item)
+                else:
+                    images.setdefault(id(item), item)
+        for image in self.untagged:
+            images.setdefault(id(image), image)
+
+        return list(images.values())
+
+    def diff(self, previous):
+        """Lists the paths that differ between a previous tree and this tree.
+
+        A path differs if the item has been added, removed or replaced. The
+        tag containing a differing item is listed as well, since its listing
+        has changed.
+
+        :param Tree previous: The previous tree.
+
+        :return: the absolute paths of all items that differ
+        :rtype: set(str)
+        """
+        result = set()
+        stack = [('', previous, self)]
+        while stack:
+            prefix, old, new = stack.pop()
+            for name in set(old) | set(new):
+                a, b = old.get(name), new.get(name)
+                path = prefix + os.path.sep + name
+                if a is b:
+                    # Tags shared between the trees have not changed
+                    continue
+                elif isinstance(a, Tag) and isinstance(b, Tag):
+                    stack.append((path, a, b))
+                elif a is not b:
+                    result.add(path)
+                    result.add(prefix or os.path.sep)
+
+        return result
+
+
+class ImageSource(object):
     """A source of images and tags.
 
-    This is an abstract class.
+    The loaded tags are available as :attr:`root`. This is an abstract class.
+
+    Image sources are read by many threads concurrently. The published tree is
+    never modified; a new tree is built by a single writer and then published
+    by replacing the reference, so readers need no locks and a reader that
+    keeps a reference to a tree sees a consistent tree for as long as it
+    needs. Readers never wait for a writer once a tree has been published.
     """
     #: A mapping of all registered sources by name to implementing classes
     SOURCES = {}
@@ -94,6 +220,7 @@ class ImageSource(dict):
     def _make_unique(self, directory, base_name, ext):
         """Creates a unique key in the map ``directory``.
 
+        If ``directory`` is a :class:`Tag`, this is a constant time operation.
         See :func:`make_unique` for more information.
 
         :param dict directory: The map in which to create the unique key.
@@ -106,15 +233,21 @@ class ImageSource(dict):
         :return: a unique key
         :rtype: str
         """
-        return make_unique(directory, base_name, '%s%s', '%s (%d)%s', ext)
+        if isinstance(directory, Tag):
+            return directory._make_unique(base_name, ext)
+        else:
+            return make_unique(
+                directory, base_name, '%s%s', '%s (%d)%s', ext)
 
-    def _make_tags(self, path):
+    def _make_tags(self, path, root):
         """Makes sure that all tags up until the last element of ``path`` exist.
 
         :param str path: The absolute path of the tag to make, for example
             ``'/Tag/Other/Third'``. This string must begin with
             :attr:`os.path.sep`.
 
+        :param Tree root: The tree in which to make the tags.
+
         :raises ValueError: if ``path`` does not begin with :attr:`os.path.sep`
 
         :return: the last tag; ``Third`` in the example above
@@ -123,41 +256,187 @@ class ImageSource(dict):
         segments = self._break_path(path)
 
         # Create all tags
-        current = self
+        current = root
         for segment in segments:
             if segment not in current:
-                tag = Tag(segment, current if current != self else None)
-                if current == self:
+                tag = Tag(segment, current if current is not root else None)
+                if current is root:
                     # If the tag does not exist, and this is a root tag
-                    # (current == self => this is the first iteration), add the
-                    # tag to self; the parent parameter to Tag above will
+                    # (current is root => this is the first iteration), add the
+                    # tag to root; the parent parameter to Tag above will
                     # handle other cases
-                    self[segment] = tag
+                    root[segment] = tag
                 current = tag
             else:
                 current = current[segment]
 
         return current
 
-    def __init__(self, **kwargs):
+    def _update_tags(self, placement, root, previous=None):
+        """Updates a tag tree so that it matches ``placement``.
+
+        Only the tags whose images or child tags differ from ``previous`` are
+        modified. Since the tags of ``root`` may be shared with a published
+        tree, every tag is copied, along with its ancestors, before it is
+        modified. Building a tree from scratch and updating it thus yield the
+        same tree: the images of a tag are added in order once all its child
+        tags exist.
+
+        :param dict placement: A mapping from absolute tag path, for example
+            ``'/Tag/Other/Third'``, to the list of images that the tag should
+            contain directly. All tags not present in this mapping, and that
+            are not ancestors of a tag present, are removed.
+
+        :param Tree root: The tree to update. This must be empty, or match
+            ``previous``.
+
+        :param dict previous: The placement matching ``root``, if it is not
+            empty.
+        """
+        previous = previous or {}
+        required = _required(placement)
+        existing = _required(previous)
+
+        # Adding or removing a tag changes the keys available to the images of
+        # its parent
+        changed = set(
+            path
+            for path in required
+            if placement.get(path, []) != previous.get(path, []))
+        changed.update(
+            path.rsplit(os.path.sep, 1)[0]
+            for path in required.symmetric_difference(existing))
+        changed.intersection_update(required)
+
+        # The tags of the tree that have been copied or created
+        writable = {'': root}
+
+        def modify(path):
+            try:
+                return writable[path]
+            except KeyError:
+                parent_path, name = path.rsplit(os.path.sep, 1)
+                parent = modify(parent_path)
+                tag = writable[path] = parent[name].copy(
+                    parent if parent is not root else None)
+                parent[name] = tag
+                return tag
+
+        # Remove the tags no longer required, unless their parents are removed
+        # as well
+        for path in existing - required:
+            parent_path, name = path.rsplit(os.path.sep, 1)
+            if not parent_path or parent_path in required:
+                del modify(parent_path)[name]
+
+        # Create the new tags; parents are created before their children since
+        # the paths are sorted
+        for path in sorted(required - existing):
+            parent_path, name = path.rsplit(os.path.sep, 1)
+            parent = modify(parent_path)
+            if parent is root:
+                tag = root[name] = Tag(name)
+            else:
+                tag = Tag(name, parent)
+            writable[path] = tag
+
+        for path in changed:
+            modify(path).replace_images(placement.get(path, []))
+
+    def __init__(self, tracer=None, **kwargs):
         """Creates a new ImageSource.
 
         :param str date_format: The date format to use when creating file names
             for images that do not have a title.
+
+        :param tracer: The tracer used to log slow loading of tags. If this is
+            not specified, nothing is traced.
+        :type tracer: photofs._trace.Tracer or None
         """
         if kwargs:
             raise ValueError(
                 'Unsupported command line argument: %s',
                 ', '.join(k for k in kwargs))
         super(ImageSource, self).__init__()
+        self._root = Tree()
+        self._listeners = []
+        self._tracer = tracer or Tracer()
+
+        # The number of trees loaded, and the total and most recent duration
+        # of loading them
+        self._refreshes = 0
+        self._refresh_duration = 0.0
+        self._last_refresh_duration = 0.0
+
+    @property
+    def root(self):
+        """The published tree of tags.
+
+        Callers that perform several lookups should read this once and pass it
+        to :meth:`locate`, since a new tree may be published at any time.
+        """
+        return self._root
+
+    @property
+    def generation(self):
+        """The generation of the published tree."""
+        return self._root.generation
+
+    @property
+    def refreshes(self):
+        """The number of times a new tree has been loaded."""
+        return self._refreshes
+
+    @property
+    def refresh_duration(self):
+        """The total number of seconds spent loading trees."""
+        return self._refresh_duration
+
+    @property
+    def last_refresh_duration(self):
+        """The number of seconds spent loading the most recent tree."""
+        return self._last_refresh_duration
+
+    def add_listener(self, listener):
+        """Registers a listener for new trees.
+
+        :param listener: A callable invoked with the previous and the new tree
+            every time a new tree is published. This is called from the thread
+            performing the refresh.
+        """
+        self._listeners.append(listener)
+
+    def _publish(self, root):
+        """Publishes a new tree and notifies all listeners.
 
-    def locate(self, path):
+        :param Tree root: The new tree.
+        """
+        previous, self._root = self._root, root
+        for listener in self._listeners:
+            listener(previous, root)
+
+    def start(self):
+        """Starts any background activity of this image source.
+
+        This is called once the file system has been mounted.
+        """
+        pass
+
+    def stop(self):
+        """Stops any background activity started by :meth:`start`."""
+        pass
+
+    def locate(self, path, root=None):
         """Locates an image or tag.
 
         :param str path: The absolute path of the item to locate, for example
             ``'/Tag/Other/Image.jpg'``. This string must begin with
             :attr:`os.path.sep`.
 
+        :param root: The tree in which to locate the item. If this is not
+            specified, :attr:`root` is used.
+        :type root: Tree or None
+
         :return: a tag or an image
         :rtype: Tag or Image
 
@@ -168,7 +447,7 @@ class ImageSource(dict):
         segments = self._break_path(path)
 
         # Locate the last item
-        current = self
+        current = self.root if root is None else root
         for segment in segments:
             current = current[segment]
 
@@ -180,6 +459,10 @@ class FileBasedImageSource(ImageSource):
 
     This is an abstract class.
     """
+    #: The version of the snapshot format; snapshots written with any other
+    #: version are ignored
+    SNAPSHOT_VERSION = 5
+
     @classmethod
     def add_arguments(self, argparser):
         """Adds all command line arguments for this image source to an argument
@@ -193,7 +476,38 @@ class FileBasedImageSource(ImageSource):
             help='The database file to use. If not specified, the default one '
             'is used.')
 
-    def __init__(self, database=None, **kwargs):
+        argparser.add_argument(
+            '--incremental-refresh',
+            help='Only apply the changes to the database when it is modified '
+            'instead of reloading all images and tags.',
+            action='store_true')
+
+        argparser.add_argument(
+            '--stat-workers',
+            help='The number of threads used to read file attributes when '
+            'loading images. The default is to not use any extra threads.',
+            type=int)
+
+        argparser.add_argument(
+            '--snapshot',
+            help='Store the loaded images and tags in the cache directory, and '
+            'use them when mounting if the database has not been modified.',
+            action='store_true')
+
+        argparser.add_argument(
+            '--refresh-interval',
+            help='The number of seconds between checks for modifications of '
+            'the database.',
+            type=float)
+
+    def __init__(
+            self,
+            database=None,
+            incremental_refresh=False,
+            snapshot=False,
+            stat_workers=1,
+            refresh_interval=1.0,
+            **kwargs):
         """Creates a new ImageSource.
 
         :param str database: The path to the backend database or directory for
@@ -201,24 +515,195 @@ class FileBasedImageSource(ImageSource):
             be a valid file name. Its timestamp is used to determine whether to
             actually reload all images and tags. If this is not provided, a
             default location is used.
+
+        :param bool incremental_refresh: Whether to call :meth:`update_tags`
+            instead of reloading everything when the backend resource has
+            changed.
+
+        :param bool snapshot: Whether to store the loaded state in
+            :attr:`snapshot_path` and to restore it instead of loading from the
+            backend resource when it has not changed.
+
+        :param int stat_workers: The number of threads used by
+            :meth:`stat_files`.
+
+        :param float refresh_interval: The number of seconds between checks
+            for modifications by the background thread started by
+            :meth:`start`.
         """
         super(FileBasedImageSource, self).__init__(**kwargs)
         self._path = database or self.default_location
         if self._path is None:
             raise ValueError('No database')
         self._timestamp = 0
-
-    def load_tags(self):
+        self._incremental_refresh = incremental_refresh
+        self._snapshot = snapshot
+        self._stat_workers = max(1, stat_workers)
+        self._refresh_interval = refresh_interval
+        self._loaded = False
+
+        # The lock serialising refreshes, and the background thread
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+
+    def load_tags(self, root):
         """Loads the tags from the backend resource.
 
         This function is called by refresh if the timestamp of the backend
         resource has changed.
 
-        :return: a list of tags with the images attached
-        :rtype: [Tag]
+        :param Tree root: The empty tree to which to add the tags. This tree is
+            not yet published.
         """
         raise NotImplementedError()
 
+    #: The number of files checked by every task of :meth:`stat_files`
+    STAT_BATCH_SIZE = 256
+
+    def stat_files(self, locations):
+        """Reads the ``lstat`` values for a list of files.
+
+        The files are checked in batches on a bounded thread pool if more than
+        one worker was requested.
+
+        :param [str] locations: The locations of the files.
+
+        :return: the ``lstat`` values in the same order as ``locations``;
+            files that cannot be read have the value ``None``
+        :rtype: [os.stat_result or None]
+        """
+        def stat_batch(batch):
+            result = []
+            for location in batch:
+                try:
+                    result.append(os.lstat(location))
+                except OSError:
+                    result.append(None)
+            return result
+
+        with phase('stat'):
+            if self._stat_workers == 1 or \
+                    len(locations) <= self.STAT_BATCH_SIZE:
+                return stat_batch(locations)
+
+            batches = [
+                locations[i:i + self.STAT_BATCH_SIZE]
+                for i in range(0, len(locations), self.STAT_BATCH_SIZE)]
+            with concurrent.futures.ThreadPoolExecutor(
+                    self._stat_workers) as executor:
+                return [
+                    st
+                    for batch in executor.map(stat_batch, batches)
+                    for st in batch]
+
+    def update_tags(self, root):
+        """Applies the changes made to the backend resource since the last
+        load to the loaded tags.
+
+        This function is called by refresh instead of :meth:`load_tags` if
+        incremental refresh is enabled and the tags have already been loaded.
+
+        The default implementation reloads all tags.
+
+        :param Tree root: A copy of the published tree to update. This tree is
+            not yet published.
+        """
+        root.clear()
+        self.load_tags(root)
+
+    def get_state(self):
+        """Returns the loaded state to store in a snapshot.
+
+        Subclasses keeping additional state between loads should extend the
+        returned value.
+
+        :return: a picklable state
+        :rtype: dict
+        """
+        return {'tags': dict(self._root)}
+
+    def set_state(self, state, root):
+        """Restores a state previously returned by :meth:`get_state`.
+
+        :param dict state: The state to restore.
+
+        :param Tree root: The empty tree to which to add the tags. This tree is
+            not yet published.
+        """
+        root.update(state['tags'])
+
+    @property
+    def snapshot_path(self):
+        """The location of the snapshot file for :attr:`path`."""
+        return os.path.join(
+            xdg_cache_home,
+            'photofs',
+            '%s.snapshot' % hashlib.sha1(
+                os.path.abspath(self._path).encode('utf-8')).hexdigest())
+
+    def _snapshot_header(self):
+        """The header identifying a snapshot of the current state.
+
+        Since the titles of images without a title are rendered from their
+        timestamps when loaded, the header includes the date format and the
+        time zone used.
+
+        :return: a tuple containing the snapshot version, the class name, the
+            path of the backend resource and its timestamp, the date format,
+            and the time zone
+        """
+        return (
+            self.SNAPSHOT_VERSION,
+            self.__class__.__name__,
+            os.path.abspath(self._path),
+            self._timestamp,
+            Image.DATE_FORMAT,
+            (time.timezone, time.altzone, time.tzname))
+
+    def _load_snapshot(self, root):
+        """Restores the state from :attr:`snapshot_path` if it was written for
+        the current timestamp of the backend resource.
+
+        :param Tree root: The empty tree to which to add the tags.
+
+        :return: whether the snapshot was restored
+        :rtype: bool
+        """
+        try:
+            with open(self.snapshot_path, 'rb') as f:
+                # The header is stored separately to avoid reading stale
+                # snapshots
+                if pickle.load(f) != self._snapshot_header():
+                    return False
+                self.set_state(pickle.load(f), root)
+                return True
+        except Exception:
+            root.clear()
+            return False
+
+    def _save_snapshot(self):
+        """Writes the current state to :attr:`snapshot_path`.
+
+        The file is replaced atomically. Failure to write the snapshot is not
+        an error.
+        """
+        path = self.snapshot_path
+        temporary = '%s.%d' % (path, os.getpid())
+        try:
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            with open(temporary, 'wb') as f:
+                pickle.dump(
+                    self._snapshot_header(), f, pickle.HIGHEST_PROTOCOL)
+                pickle.dump(self.get_state(), f, pickle.HIGHEST_PROTOCOL)
+            os.rename(temporary, path)
+        except Exception:
+            try:
+                os.unlink(temporary)
+            except OSError:
+                pass
+
     @property
     def default_location(self):
         """Returns the default location of the backend resource.
@@ -234,12 +719,27 @@ class FileBasedImageSource(ImageSource):
         """The path of the backend resource containing the images and tags."""
         return self._path
 
+    @property
+    def refresh_interval(self):
+        """The number of seconds between checks for modifications by the
+        background thread; if this is not positive, no thread is started."""
+        return self._refresh_interval
+
     @property
     def timestamp(self):
         """The timestamp when the backend resource was last modified."""
         return self._timestamp
 
-    def refresh(self):
+    @property
+    def root(self):
+        # Load the tags on first access, and check for modifications on every
+        # access unless the background thread does it; once a tree has been
+        # published, a reader does not wait for a refresh in progress
+        if self._thread is None or not self._loaded:
+            self.refresh(not self._loaded)
+        return self._root
+
+    def refresh(self, wait=True):
         """Reloads all images and tags from the backend resource if it has
         changed since the last update.
 
@@ -247,19 +747,97 @@ class FileBasedImageSource(ImageSource):
         resource is considered to be changed as well.
 
         In this case, the internal timestamp is updated and :meth:`load_tags`
-        is called.
-        """
-        # Check the timestamp
-        if self.path:
-            timestamp = os.stat(self._path).st_mtime
-            if timestamp == self._timestamp:
-                return
-            self._timestamp = timestamp
-
-        # Release the old data and reload the tags
-        self.clear()
-        self.load_tags()
-
-    def locate(self, path):
-        self.refresh()
-        return super(FileBasedImageSource, self).locate(path)
+        is called to populate a new tree, or :meth:`update_tags` to update a
+        copy of the current tree if incremental refresh is enabled and the tags
+        have been loaded previously. The new tree is then published by
+        replacing :attr:`root`; the previous tree is left untouched for
+        readers still using it.
+
+        Refreshes are serialised.
+
+        :param bool wait: Whether to wait for a refresh in progress in another
+            thread to finish. If this is ``False`` and another thread is
+            refreshing, this method returns immediately.
+        """
+        if not self._lock.acquire(wait):
+            return
+        try:
+            # Check the timestamp
+            if self.path:
+                timestamp = os.stat(self._path).st_mtime
+                if timestamp == self._timestamp:
+                    return
+                self._timestamp = timestamp
+
+            with self._tracer.trace('refresh', self._path):
+                start = time.time()
+                generation = self._root.generation + 1
+                if self._incremental_refresh and self._loaded:
+                    # Only apply the changes
+                    root = self._root.copy(generation)
+                    with phase('tags'):
+                        self.update_tags(root)
+                    store = True
+                else:
+                    # Use the snapshot if possible, or reload the tags
+                    root = Tree(generation)
+                    with phase('snapshot'):
+                        store = not (
+                            self.path and self._snapshot and
+                            not self._loaded and
+                            self._load_snapshot(root))
+                    if store:
+                        with phase('tags'):
+                            self.load_tags(root)
+
+                # Publish the new tree
+                with phase('publish'):
+                    self._publish(root)
+                self._loaded = True
+
+                duration = time.time() - start
+                self._refreshes += 1
+                self._refresh_duration += duration
+                self._last_refresh_duration = duration
+
+                if store and self.path and self._snapshot:
+                    with phase('snapshot'):
+                        self._save_snapshot()
+
+        finally:
+            self._lock.release()
+
+    def start(self):
+        """Starts a background thread checking for modifications of the
+        backend resource every ``refresh_interval`` seconds.
+
+        Once started, :attr:`root` no longer checks for modifications.
+        """
+        if self._thread is not None or self._refresh_interval <= 0:
+            return
+
+        self._stopped.clear()
+        self._thread = threading.Thread(
+            target=self._run,
+            name='photofs-refresh')
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        if self._thread is None:
+            return
+
+        self._stopped.set()
+        self._thread.join()
+        self._thread = None
+
+    def _run(self):
+        """The body of the background thread.
+        """
+        while not self._stopped.wait(self._refresh_interval):
+            try:
+                self.refresh()
+            except Exception:
+                logging.getLogger(__name__).exception(
+                    'Failed to refresh %s',
+                    self.path)
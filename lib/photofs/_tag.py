@@ -17,7 +17,7 @@
 # this program. If not, see <http://www.gnu.org/licenses/>.
 
 from ._image import Image
-from ._util import make_unique
+from ._util import KeyAllocator
 
 
 class Tag(dict):
@@ -35,7 +35,8 @@ class Tag(dict):
     def _make_unique(self, base_name, ext):
         """Creates a unique key in this dict.
 
-        See :func:`make_unique` for more information.
+        The key must be added to this dict before another key is created. See
+        :func:`make_unique` for more information.
 
         :param str base_name: The name of the file without extension.
 
@@ -45,7 +46,7 @@ class Tag(dict):
         :return: a unique key
         :rtype: str
         """
-        return make_unique(self, base_name, '%s%s', '%s (%d)%s', ext)
+        return self._keys(self, base_name, ext)
 
     def __setitem__(self, k, v):
         # Make sure keys are strings and items are images or tags
@@ -58,6 +59,14 @@ class Tag(dict):
 
         super(Tag, self).__setitem__(k, v)
 
+    def __delitem__(self, k):
+        super(Tag, self).__delitem__(k)
+        self._keys.reset()
+
+    def clear(self):
+        super(Tag, self).clear()
+        self._keys.reset()
+
     def __init__(self, name, parent=None):
         """Initialises a named tag.
 
@@ -74,8 +83,12 @@ class Tag(dict):
         self._has_video = False
         self._has_image = False
 
-        # Make sure to add ourselves to the parent tag if specified
-        if parent:
+        # Used to create unique keys for images
+        self._keys = KeyAllocator('%s%s', '%s (%d)%s')
+
+        # Make sure to add ourselves to the parent tag if specified; an empty
+        # parent is still a parent
+        if parent is not None:
             parent.add(self)
 
     @property
@@ -98,6 +111,45 @@ class Tag(dict):
         """Whether this tag contains at least one video"""
         return self._has_video
 
+    def copy(self, parent=None):
+        """Creates a copy of this tag.
+
+        Neither child tags nor images are copied; the copy contains the same
+        items, so unchanged tags may be shared between trees. The parent of
+        the child tags is not changed.
+
+        :param Tag parent: The parent of the copy. The copy is not added to
+            the parent.
+
+        :return: a copy of this tag
+        :rtype: Tag
+        """
+        result = Tag(self._name)
+        result._parent = parent
+        result._has_image = self._has_image
+        result._has_video = self._has_video
+        result._keys = self._keys.copy()
+        result.update(self)
+
+        return result
+
+    def replace_images(self, images):
+        """Replaces all images of this tag.
+
+        The images are given the same keys as if they were added in order to
+        a new tag containing only the child tags of this tag.
+
+        :param images: The new images.
+        :type images: [Image]
+        """
+        for k in [k for k, v in self.items() if isinstance(v, Image)]:
+            super(Tag, self).__delitem__(k)
+        self._keys.reset()
+        self._has_image = False
+        self._has_video = False
+        for image in images:
+            self.add(image)
+
     def add(self, item):
         """Adds an image or tag to this tag.
 
@@ -112,6 +164,9 @@ class Tag(dict):
             An image or a tag.
         :type item: Image or Tag
 
+        :return: the key under which the item was stored
+        :rtype: str
+
         :raises ValueError: if item is not an instance of :class:`Image` or
             :class:`Tag`
         """
@@ -123,6 +178,8 @@ class Tag(dict):
             self._has_image = self._has_image or not item.is_video
             self._has_video = self._has_image or item.is_video
 
+            return key
+
         elif isinstance(item, Tag):
             previous = self.get(item.name)
             self[item.name] = item
@@ -134,6 +191,8 @@ class Tag(dict):
             self._has_image = self._has_image or item.has_video
             self._has_video = self._has_image or item.has_image
 
+            return item.name
+
         else:
             raise ValueError(
                 'Cannot add %s to a Tag',
@@ -0,0 +1,310 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import bisect
+import calendar
+import collections
+import datetime
+import threading
+import time
+
+from ._util import KeyAllocator
+
+
+def _start(date):
+    """Returns the timestamp of the beginning of a period in local time.
+
+    :param tuple date: The period as the tuple ``(year,)``,
+        ``(year, month)`` or ``(year, month, day)``.
+
+    :return: the timestamp, in seconds since the epoch
+    :rtype: float
+
+    :raises ValueError: if ``date`` is not a valid date
+    """
+    year, month, day = (date + (1, 1))[:3]
+    datetime.date(year, month, day)
+    return time.mktime((year, month, day, 0, 0, 0, 0, 0, -1))
+
+
+def _following(date):
+    """Returns the period following a period of the same length.
+
+    :param tuple date: The period as the tuple ``(year,)``,
+        ``(year, month)`` or ``(year, month, day)``.
+
+    :return: the following period
+    :rtype: tuple
+    """
+    if len(date) == 1:
+        return (date[0] + 1,)
+    elif len(date) == 2:
+        return (date[0] + 1, 1) if date[1] == 12 else (date[0], date[1] + 1)
+    else:
+        following = datetime.date(*date) + datetime.timedelta(days=1)
+        return (following.year, following.month, following.day)
+
+
+def _year(timestamp):
+    """Returns the year of a timestamp in local time.
+
+    :param float timestamp: The timestamp, in seconds since the epoch.
+
+    :return: the year, limited to the years supported by :mod:`datetime`
+    :rtype: int
+    """
+    try:
+        year = time.localtime(timestamp).tm_year
+    except (OverflowError, OSError, ValueError):
+        return datetime.MAXYEAR if timestamp > 0 else datetime.MINYEAR
+    return min(max(year, datetime.MINYEAR), datetime.MAXYEAR)
+
+
+def _parse(name):
+    """Parses the name of a period.
+
+    :param str name: The name, formatted as ``YYYY``, ``YYYY-MM`` or
+        ``YYYY-MM-DD``.
+
+    :return: the period as the tuple ``(year,)``, ``(year, month)`` or
+        ``(year, month, day)``
+
+    :raises ValueError: if ``name`` is not a valid period
+    """
+    date = tuple(int(part) for part in name.split('-'))
+    if not 1 <= len(date) <= 3:
+        raise ValueError(name)
+    _start(date)
+    return date
+
+
+class Period(dict):
+    """A directory of the timeline, mapping names to periods or images.
+
+    A period is created empty, and its entries are added when it is first
+    located in its :class:`Timeline`.
+    """
+    __slots__ = (
+        'start',
+        'end',
+        'date',
+        'names')
+
+    def __init__(self, start, end, date):
+        """Creates an empty period.
+
+        :param int start: The position in the timeline of the first image.
+
+        :param int end: The position in the timeline following the last image.
+
+        :param date: The period as the tuple ``()`` for the entire timeline,
+            ``(year,)``, ``(year, month)`` or ``(year, month, day)``, or
+            ``None`` for a range of days, which lists its images directly.
+        :type date: tuple or None
+        """
+        super(Period, self).__init__()
+        self.start = start
+        self.end = end
+        self.date = date
+
+        #: The names of all entries once the period has been filled, or
+        #: ``None``
+        self.names = None
+
+
+class Timeline(object):
+    """All images of a tree sorted by timestamp, presented as directories
+    for years, months and days.
+
+    Directories are filled with entries when they are first located; the
+    images of a period are found by a binary search of the timestamps, so
+    creating the timeline only requires sorting the images, and a library
+    spanning decades costs nothing more until its years are browsed.
+
+    Directories named ``first..last`` beneath the root, where ``first`` and
+    ``last`` are formatted as ``YYYY``, ``YYYY-MM`` or ``YYYY-MM-DD``, contain
+    all images from the beginning of ``first`` to the end of ``last``. They
+    are not listed, and only the most recently located ranges are kept.
+
+    The timeline is only valid for the tree from which it was created.
+    """
+    #: The separator between the first and the last period of a range
+    RANGE_SEPARATOR = '..'
+
+    #: The number of ranges to keep
+    RANGE_CACHE_SIZE = 16
+
+    def __init__(self, tree):
+        """Creates a timeline of all images of a tree.
+
+        :param Tree tree: The tree.
+        """
+        super(Timeline, self).__init__()
+        self._images = sorted(
+            tree.images(),
+            key=lambda image: image.posix_timestamp)
+        self._timestamps = [image.posix_timestamp for image in self._images]
+        self._lock = threading.Lock()
+        self._root = Period(0, len(self._images), ())
+        self._ranges = collections.OrderedDict()
+
+    def __len__(self):
+        return len(self._images)
+
+    def locate(self, segments):
+        """Locates a period or an image.
+
+        :param [str] segments: The path elements beneath the root of the
+            timeline, for example ``['2016', '01', '31', 'Image.jpg']``.
+
+        :return: a period or an image
+        :rtype: Period or Image
+
+        :raises KeyError: if the item does not exist
+        """
+        current = self._fill(self._root)
+        for segment in segments:
+            if not isinstance(current, Period):
+                raise KeyError(segment)
+            elif current is self._root and self.RANGE_SEPARATOR in segment:
+                current = self._range(segment)
+            else:
+                current = current[segment]
+            if isinstance(current, Period):
+                self._fill(current)
+
+        return current
+
+    def _range(self, name):
+        """Returns the directory for a range of periods, creating it unless it
+        is cached.
+
+        :param str name: The name of the directory.
+
+        :return: a period
+        :rtype: Period
+
+        :raises KeyError: if ``name`` is not a valid range
+        """
+        with self._lock:
+            try:
+                period = self._ranges[name]
+                self._ranges.move_to_end(name)
+                return period
+            except KeyError:
+                pass
+
+        try:
+            first, last = (
+                _parse(part) for part in name.split(self.RANGE_SEPARATOR))
+            start = _start(first)
+        except (OverflowError, ValueError):
+            raise KeyError(name)
+
+        # Like the directories of the timeline, the first and last periods
+        # that can be represented contain all images preceding and following
+        # them
+        timestamps = self._timestamps
+        lower = 0 if first == (datetime.MINYEAR, 1, 1)[:len(first)] \
+            else bisect.bisect_left(timestamps, start)
+        try:
+            end = _start(_following(last))
+        except (OverflowError, ValueError):
+            upper = len(timestamps)
+        else:
+            if end <= start:
+                raise KeyError(name)
+            upper = bisect.bisect_left(timestamps, end, lower)
+        period = Period(lower, upper, None)
+
+        with self._lock:
+            period = self._ranges.setdefault(name, period)
+            while len(self._ranges) > self.RANGE_CACHE_SIZE:
+                self._ranges.popitem(last=False)
+
+        return period
+
+    def _fill(self, period):
+        """Adds the entries of a period unless already added.
+
+        :param Period period: The period.
+
+        :return: ``period``
+        """
+        if period.names is not None:
+            return period
+
+        with self._lock:
+            if period.names is not None:
+                return period
+
+            if period.date is None or len(period.date) == 3:
+                keys = KeyAllocator('%s%s', '%s (%d)%s')
+                for image in self._images[period.start:period.end]:
+                    period[keys(
+                        period,
+                        image.title,
+                        '.' + image.extension)] = image
+
+            else:
+                timestamps = self._timestamps
+                lower = period.start
+                for date in self._children(period):
+                    # Images following the last period that can be
+                    # represented belong to it
+                    try:
+                        upper = bisect.bisect_left(
+                            timestamps,
+                            _start(_following(date)),
+                            lower,
+                            period.end)
+                    except (OverflowError, ValueError):
+                        upper = period.end
+                    if upper > lower:
+                        period['%02d' % date[-1] if len(date) > 1
+                               else '%04d' % date[0]] = Period(
+                                   lower, upper, date)
+                    lower = upper
+
+            period.names = list(period)
+
+        return period
+
+    def _children(self, period):
+        """Lists the periods directly beneath a period.
+
+        :param Period period: The period, which must be the entire timeline, a
+            year or a month.
+
+        :return: the child periods, in order
+        :rtype: [tuple]
+        """
+        date = period.date
+        if not date:
+            if period.start == period.end:
+                return []
+            first, last = (
+                _year(self._timestamps[i])
+                for i in (period.start, period.end - 1))
+            return [(year,) for year in range(first, last + 1)]
+        elif len(date) == 1:
+            return [date + (month,) for month in range(1, 13)]
+        else:
+            return [
+                date + (day,)
+                for day in range(1, calendar.monthrange(*date)[1] + 1)]
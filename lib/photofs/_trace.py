@@ -0,0 +1,354 @@
+#!/usr/bin/env python
+# coding: utf-8
+# photofs
+# Copyright (C) 2012-2016 Moses Palmér
+#
+# This program is free software: you can redistribute it and/or modify it under
+# the terms of the GNU General Public License as published by the Free Software
+# Foundation, either version 3 of the License, or (at your option) any later
+# version.
+#
+# This program is distributed in the hope that it will be useful, but WITHOUT
+# ANY WARRANTY; without even the implied warranty of MERCHANTABILITY or FITNESS
+# FOR A PARTICULAR PURPOSE. See the GNU General Public License for more
+# details.
+#
+# You should have received a copy of the GNU General Public License along with
+# this program. If not, see <http://www.gnu.org/licenses/>.
+
+import collections
+import logging
+import os
+import signal
+import sys
+import threading
+import time
+
+
+class _Current(threading.local):
+    """The trace of the operation currently performed by a thread.
+    """
+    #: The trace, or ``None`` if no operation is traced; this is a class
+    #: attribute to make lookups cheap for threads never tracing anything
+    trace = None
+
+
+_current = _Current()
+
+
+class _Null(object):
+    """A context manager doing nothing.
+    """
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        pass
+
+    def defer(self):
+        pass
+
+    def finish(self):
+        pass
+
+
+#: The context manager returned when nothing is traced
+_NULL = _Null()
+
+
+class _Phase(object):
+    """A context manager measuring the time spent in a phase of a traced
+    operation.
+
+    The time of nested phases is not included in the time of the outer phase.
+    """
+    __slots__ = (
+        '_trace',
+        '_name',
+        '_start',
+        '_nested')
+
+    def __init__(self, trace, name):
+        self._trace = trace
+        self._name = name
+
+    def __enter__(self):
+        self._start = time.time()
+        self._nested = 0.0
+        self._trace.stack.append(self)
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        duration = time.time() - self._start
+        stack = self._trace.stack
+        stack.pop()
+        if stack:
+            stack[-1]._nested += duration
+        self._trace.phases[self._name] += duration - self._nested
+
+
+class _Trace(object):
+    """The phases of a traced operation.
+    """
+    __slots__ = (
+        'phases',
+        'stack')
+
+    def __init__(self):
+        self.phases = collections.defaultdict(float)
+        self.stack = []
+
+
+def phase(name):
+    """Returns a context manager measuring the time spent in a phase of the
+    operation traced by the current thread.
+
+    If the current thread is not tracing an operation, this is very cheap.
+
+    :param str name: The name of the phase.
+    """
+    trace = _current.trace
+    if trace is None:
+        return _NULL
+    else:
+        return _Phase(trace, name)
+
+
+class Tracer(object):
+    """Logs operations taking longer than a threshold, with the time spent in
+    every phase of the operation.
+
+    Phases are marked using :func:`phase`.
+    """
+    def __init__(self, threshold=None):
+        """Creates a tracer.
+
+        :param threshold: The minimum duration, in seconds, of operations to
+            log. If this is ``None``, nothing is traced.
+        :type threshold: float or None
+        """
+        self._threshold = threshold
+        self._log = logging.getLogger(__name__)
+
+    @property
+    def enabled(self):
+        """Whether operations are traced."""
+        return self._threshold is not None
+
+    def trace(self, operation, *args):
+        """Returns a context manager tracing an operation.
+
+        Operations nested in a traced operation are not traced separately.
+
+        :param str operation: The name of the operation.
+
+        :param args: Arguments identifying the operation in the log, such as
+            the path.
+        """
+        if self._threshold is None or \
+                _current.trace is not None:
+            return _NULL
+        else:
+            return _Operation(self, operation, args)
+
+    def _report(self, operation, args, duration, phases):
+        """Logs an operation if it took longer than the threshold.
+
+        :param str operation: The name of the operation.
+
+        :param tuple args: The arguments passed to :meth:`trace`.
+
+        :param float duration: The duration of the operation.
+
+        :param dict phases: The time spent in every phase.
+        """
+        if duration < self._threshold:
+            return
+
+        other = duration - sum(phases.values())
+        self._log.warning(
+            'Slow operation: %s(%s) took %.3f s (%s)',
+            operation,
+            ', '.join(repr(arg) for arg in args),
+            duration,
+            ', '.join(
+                '%s %.3f s' % (name, seconds)
+                for name, seconds in sorted(phases.items()) + [
+                    ('other', max(0.0, other))]))
+
+
+class _Operation(object):
+    """A context manager tracing an operation.
+
+    An operation performed in several steps, such as a directory listing read
+    page by page, is traced by calling :meth:`defer` in the first step,
+    entering the context manager again for every following step and finally
+    calling :meth:`finish`.
+    """
+    __slots__ = (
+        '_tracer',
+        '_operation',
+        '_args',
+        '_trace',
+        '_outer',
+        '_duration',
+        '_deferred',
+        '_start')
+
+    def __init__(self, tracer, operation, args):
+        self._tracer = tracer
+        self._operation = operation
+        self._args = args
+        self._trace = _Trace()
+        self._duration = 0.0
+        self._deferred = False
+
+    def __enter__(self):
+        self._outer = _current.trace
+        _current.trace = self._trace
+        self._start = time.time()
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self._duration += time.time() - self._start
+        _current.trace = self._outer
+        self._outer = None
+        if not self._deferred:
+            self.finish()
+
+    def defer(self):
+        """Defers logging the operation until :meth:`finish` is called.
+        """
+        self._deferred = True
+
+    def finish(self):
+        """Logs the operation if it took longer than the threshold.
+        """
+        self._tracer._report(
+            self._operation,
+            self._args,
+            self._duration,
+            self._trace.phases)
+
+
+class SamplingProfiler(object):
+    """A profiler periodically sampling the stacks of all threads.
+
+    Unlike :mod:`cProfile`, this also covers threads created outside of
+    *Python*, such as the worker threads of *FUSE*, and it may be started and
+    stopped from any thread.
+
+    The samples are written in the *collapsed stack* format used by flame
+    graph tools: every line contains the frames of a stack, outermost first
+    and separated by ``;``, followed by the number of samples.
+    """
+    def __init__(self, path, interval=0.005):
+        """Creates a stopped profiler.
+
+        :param str path: The file to which to write the samples when the
+            profiler is stopped. This is overwritten.
+
+        :param float interval: The number of seconds between samples.
+        """
+        self._path = path
+        self._interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._stopped = threading.Event()
+        self._samples = collections.Counter()
+
+    @property
+    def running(self):
+        """Whether the profiler is running."""
+        return self._thread is not None
+
+    def start(self):
+        """Starts sampling, unless already started.
+        """
+        with self._lock:
+            if self._thread is not None:
+                return
+            self._samples.clear()
+            self._stopped.clear()
+            self._thread = threading.Thread(
+                target=self._run,
+                name='photofs-profiler')
+            self._thread.daemon = True
+            self._thread.start()
+        logging.getLogger(__name__).info('Profiler started')
+
+    def stop(self):
+        """Stops sampling and writes the samples, unless already stopped.
+        """
+        with self._lock:
+            if self._thread is None:
+                return
+            self._stopped.set()
+            self._thread.join()
+            self._thread = None
+
+            with open(self._path, 'w') as f:
+                for stack, count in self._samples.most_common():
+                    f.write('%s %d\n' % (stack, count))
+        logging.getLogger(__name__).info(
+            'Profiler stopped; samples written to %s',
+            self._path)
+
+    def toggle(self):
+        """Starts the profiler if it is stopped, otherwise stops it.
+        """
+        if self.running:
+            self.stop()
+        else:
+            self.start()
+
+    def listen(self, signum):
+        """Starts a thread toggling the profiler whenever a signal is
+        received.
+
+        The signal must be blocked in all threads by calling :meth:`block`
+        from the main thread before any other threads are started, since the
+        main thread may never return to the interpreter to run a signal
+        handler while the file system is mounted.
+
+        :param int signum: The signal number.
+        """
+        def run():
+            while True:
+                signal.sigwait((signum,))
+                try:
+                    self.toggle()
+                except Exception:
+                    logging.getLogger(__name__).exception(
+                        'Failed to toggle profiler')
+
+        thread = threading.Thread(target=run, name='photofs-profiler-signal')
+        thread.daemon = True
+        thread.start()
+
+    @staticmethod
+    def block(signum):
+        """Blocks a signal in the current thread and all threads it starts.
+
+        :param int signum: The signal number.
+        """
+        signal.pthread_sigmask(signal.SIG_BLOCK, (signum,))
+
+    def _run(self):
+        """Samples the stacks of all threads until stopped.
+        """
+        ident = threading.current_thread().ident
+        samples = self._samples
+        while not self._stopped.wait(self._interval):
+            for thread, frame in sys._current_frames().items():
+                if thread == ident:
+                    continue
+                frames = []
+                while frame is not None:
+                    code = frame.f_code
+                    frames.append('%s (%s:%d)' % (
+                        code.co_name,
+                        os.path.basename(code.co_filename),
+                        code.co_firstlineno))
+                    frame = frame.f_back
+                samples[';'.join(reversed(frames))] += 1
@@ -44,3 +44,75 @@ def make_unique(mapping, base_name, format_1, format_n, *args):
         key = format_n % ((base_name, i) + args)
 
     return key
+
+
+class KeyAllocator(object):
+    """Creates unique keys in a ``dict`` in constant time.
+
+    The keys created are the same as those created by :func:`make_unique`, but
+    for every base name and set of format string arguments, the highest index
+    known to be taken is remembered, so that probing does not restart from the
+    beginning.
+
+    This requires that all keys created are actually added to the ``dict``,
+    and that :meth:`reset` is called whenever keys are removed from it.
+    """
+    def __init__(self, format_1, format_n):
+        """Creates a key allocator.
+
+        :param str format_1: The initial format string. This will be passed
+            the base name followed by the format string arguments.
+
+        :param str format_n: The fallback format string. This will be passed
+            the base name followed by an index and then the format string
+            arguments.
+        """
+        super(KeyAllocator, self).__init__()
+        self._format_1 = format_1
+        self._format_n = format_n
+        self._taken = {}
+
+    def __call__(self, mapping, base_name, *args):
+        """Creates a unique key in a ``dict``.
+
+        :param dict mapping: The ``dict`` in which to create the key. This must
+            be the same ``dict`` for all calls.
+
+        :param str base_name: The name of the file without extension.
+
+        :param args: Format string arguments used.
+
+        :return: a unique key
+        :rtype: str
+        """
+        counter = (base_name,) + args
+        i = self._taken.get(counter, 0)
+        while True:
+            i += 1
+            if i == 1:
+                key = self._format_1 % ((base_name,) + args)
+            else:
+                key = self._format_n % ((base_name, i) + args)
+            if key not in mapping:
+                break
+
+        self._taken[counter] = i
+        return key
+
+    def copy(self):
+        """Creates a copy of this key allocator.
+
+        :return: a copy
+        :rtype: KeyAllocator
+        """
+        result = KeyAllocator(self._format_1, self._format_n)
+        result._taken.update(self._taken)
+        return result
+
+    def reset(self):
+        """Forgets all taken keys.
+
+        This must be called when keys are removed from the ``dict``, since the
+        lowest free key may then change.
+        """
+        self._taken.clear()
@@ -17,10 +17,16 @@
 
 import os
 
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
+
 from xdg.BaseDirectory import xdg_data_dirs
 
 from photofs._image import FileBasedImage
 from photofs._source import ImageSource, FileBasedImageSource
+from photofs._trace import phase
 
 
 # Try to import sqlite
@@ -34,11 +40,42 @@ except ImportError:
 class ShotwellSource(FileBasedImageSource):
     """Loads images and videos from Shotwell.
     """
+    #: The descriptions of the different image tables; the value tuple is the
+    #: header of the ID in the tag table and whether the table contains videos
+    TABLES = {
+        'phototable': ('thumb', False),
+        'videotable': ('video-', True)}
+
+    #: The number of rows fetched from the database at a time
+    FETCH_SIZE = 1024
+
+    @classmethod
+    def add_arguments(self, argparser):
+        super(ShotwellSource, self).add_arguments(argparser)
+
+        argparser.add_argument(
+            '--untagged',
+            help='Load images that have no tags as well. They are only '
+            'visible in the timeline.',
+            action='store_true')
+
     def __init__(self, *args, **kwargs):
         if sqlite3 is None:
             raise RuntimeError('This program requires sqlite3')
+
+        # Whether to load images without tags
+        self._include_untagged = kwargs.pop('untagged', False)
+
         super(ShotwellSource, self).__init__(*args, **kwargs)
 
+        # The rows, images and tags read by the last load, and the images
+        # placed in every tag; these are used to find what has changed when
+        # updating incrementally
+        self._rows = {}
+        self._images = {}
+        self._tags = []
+        self._placed = {}
+
     @property
     def default_location(self):
         """Determines the location of the *Shotwell* database.
@@ -52,84 +89,317 @@ class ShotwellSource(FileBasedImageSource):
             if os.access(result, os.R_OK):
                 return result
 
-    def load_tags(self):
-        db = sqlite3.connect(self._path)
+    def _connect(self):
+        """Opens the database for reading.
+
+        The database is opened read-only, so that loading never takes any
+        write locks or creates a journal.
+
+        :return: a database connection
+        """
+        return sqlite3.connect(
+            'file:%s?mode=ro' % pathname2url(os.path.abspath(self._path)),
+            uri=True)
+
+    def _fetch(self, db, statement):
+        """Executes a statement and yields the result rows in bounded
+        batches.
+
+        :param db: The database connection.
+
+        :param str statement: The statement to execute.
+
+        :return: a generator of lists of rows
+        """
+        cursor = db.execute(statement)
         try:
-            # The descriptions of the different image tables; the value tuple
-            # is the header of the ID in the tag table, the map of IDs to
-            # images and whether the table contains videos
-            db_tables = {
-                'phototable': ('thumb', {}, False),
-                'videotable': ('video-', {}, True)}
-
-            # Load the images
-            for table_name, (header, images, is_video) in db_tables.items():
-                results = db.execute("""
-                    SELECT id, filename, exposure_time, title
-                        FROM %s""" % table_name)
-                for r_id, r_filename, r_exposure_time, r_title in results:
-                    try:
-                        images[r_id] = FileBasedImage(
-                            r_title,
-                            r_filename,
-                            r_exposure_time,
-                            is_video)
-                    except OSError:
-                        # Ignore unreadable files
-                        pass
-
-            # Load the tags
-            results = db.execute("""
+            while True:
+                rows = cursor.fetchmany(self.FETCH_SIZE)
+                if not rows:
+                    break
+                yield rows
+        finally:
+            cursor.close()
+
+    def _parse_id(self, i):
+        """Parses an image ID from the tag table.
+
+        :param str i: The ID.
+
+        :return: the tuple ``(table_name, row_id)``, or ``None`` if the ID is
+            invalid
+        """
+        if i[:1].isdigit():
+            # If the first character is a digit, this is a legacy source ID
+            # and an ID in the photo table
+            return ('phototable', int(i))
+
+        # Locate the database table for the current ID
+        for table_name, (header, is_video) in self.TABLES.items():
+            if i.startswith(header):
+                try:
+                    return (table_name, int(i[len(header):], 16))
+                except ValueError:
+                    return None
+
+    def _read_tags(self, db):
+        """Reads all used tags from the tag table.
+
+        Every distinct image ID is parsed only once, and the same key is
+        shared by all tags referencing it.
+
+        :param db: The database connection.
+
+        :return: the tuple ``(tags, referenced)``, where ``tags`` is a list of
+            the tuples ``(path, keys)``, where ``path`` is the absolute path of
+            the tag and ``keys`` the list of tuples ``(table_name, row_id)``
+            identifying images, ordered by tag name, and ``referenced`` is a
+            mapping from table name to the set of referenced row IDs
+        :rtype: ([(str, [(str, int)])], dict)
+        """
+        tags = []
+        parsed = {}
+        for results in self._fetch(db, """
                 SELECT name, photo_id_list
                     FROM tagtable
-                    ORDER BY name""")
+                    ORDER BY name"""):
             for r_name, r_photo_id_list in results:
                 # Ignore unused tags
                 if not r_photo_id_list:
                     continue
 
                 # Hierachial tag names start with '/'
-                path = r_name.split('/') if r_name[0] == '/' else ['', r_name]
-                path_name = os.path.sep.join(path)
-
-                # Make sure that the tag and all its parents exist
-                tag = self._make_tags(path_name)
+                path = r_name.split('/') if r_name[0] == '/' \
+                    else ['', r_name]
 
                 # The IDs are all in the text of photo_id_list, separated by
                 # commas; there is an extra comma at the end
-                ids = r_photo_id_list.split(',')[:-1]
-
-                # Iterate over all image IDs and move them to this tag
-                for i in ids:
-                    if i[0].isdigit():
-                        # If the first character is a digit, this is a legacy
-                        # source ID and an ID in the photo table
-                        image = db_tables['phototable'][1].get(int(i))
-                    else:
-                        # Iterate over all database tables and locate the image
-                        # instance for the current ID
-                        image = None
-                        for table_name, (header, images, is_video) \
-                                in db_tables.items():
-                            if not i.startswith(header):
-                                continue
-                            image = images.get(int(i[len(header):], 16))
-                            break
-
-                    # Verify that the tag only references existing images
-                    if image is None:
-                        continue
-
-                    # Remove the image from the parent tags
-                    parent = tag.parent
-                    while parent:
-                        for k, v in parent.items():
-                            if v == image:
-                                del parent[k]
-                        parent = parent.parent
-
-                    # Finally add the image to this tag
-                    tag.add(image)
+                ids = r_photo_id_list.split(',')
+                ids.pop()
+                for i in set(ids).difference(parsed):
+                    parsed[i] = self._parse_id(i)
+                tags.append((
+                    os.path.sep.join(path),
+                    [key for key in map(parsed.__getitem__, ids) if key]))
 
-        finally:
-            db.close()
+        referenced = dict((table_name, set()) for table_name in self.TABLES)
+        for key in parsed.values():
+            if key:
+                referenced[key[0]].add(key[1])
+
+        return tags, referenced
+
+    def _read_images(self, db, referenced):
+        """Reads the referenced rows from the image tables.
+
+        :param db: The database connection.
+
+        :param referenced: A mapping from table name to the set of row IDs to
+            read, as returned by :meth:`_read_tags`, or ``None`` to read all
+            rows.
+        :type referenced: dict or None
+
+        :return: a mapping from table name to a mapping from row ID to the
+            tuple ``(filename, exposure_time, title)``
+        :rtype: dict
+        """
+        rows = {}
+        for table_name in self.TABLES:
+            wanted = referenced[table_name] if referenced is not None \
+                else None
+            table_rows = rows[table_name] = {}
+            for results in self._fetch(db, """
+                    SELECT id, filename, exposure_time, title
+                        FROM %s""" % table_name):
+                for r_id, r_filename, r_exposure_time, r_title in results:
+                    if wanted is None or r_id in wanted:
+                        table_rows[r_id] = (
+                            r_filename, r_exposure_time, r_title)
+
+        return rows
+
+    def _read(self):
+        """Reads the tags and the images they reference from the database.
+
+        If images without tags are loaded, all images are read.
+
+        :return: the tuple ``(rows, tags)``, as returned by
+            :meth:`_read_images` and :meth:`_read_tags`
+        """
+        with phase('query'):
+            db = self._connect()
+            try:
+                tags, referenced = self._read_tags(db)
+                rows = self._read_images(
+                    db,
+                    None if self._include_untagged else referenced)
+            finally:
+                db.close()
+
+        return rows, tags
+
+    def _load_images(self, rows, previous_rows={}, previous_images={}):
+        """Creates images for all rows read by :meth:`_read_images`.
+
+        Files that cannot be read are ignored. Images without a title are
+        given one rendered from their timestamp; the rendered titles are
+        shared between images with the same timestamp.
+
+        :param dict rows: The image rows.
+
+        :param dict previous_rows: Image rows from a previous load.
+
+        :param dict previous_images: The images created from
+            ``previous_rows``. Images whose rows have not changed are reused.
+
+        :return: a mapping from table name to a mapping from row ID to image
+        :rtype: dict
+        """
+        images = {}
+        pending = []
+        for table_name, table_rows in rows.items():
+            old_rows = previous_rows.get(table_name, {})
+            old_images = previous_images.get(table_name, {})
+            table_images = images[table_name] = {}
+            for r_id, row in table_rows.items():
+                image = old_images.get(r_id)
+                if image is not None and old_rows.get(r_id) == row:
+                    table_images[r_id] = image
+                else:
+                    pending.append((table_name, r_id, row))
+
+        # Check all new files in one batch
+        stats = self.stat_files([row[0] for _, _, row in pending])
+
+        titles = {}
+        for (table_name, r_id, row), st in zip(pending, stats):
+            # Ignore unreadable files
+            if st is None:
+                continue
+
+            header, is_video = self.TABLES[table_name]
+            r_filename, r_exposure_time, r_title = row
+            if not r_title:
+                try:
+                    r_title = titles[r_exposure_time]
+                except KeyError:
+                    r_title = titles[r_exposure_time] = \
+                        FileBasedImage.format_timestamp(r_exposure_time)
+            images[table_name][r_id] = FileBasedImage(
+                r_title,
+                r_filename,
+                r_exposure_time,
+                is_video,
+                st)
+
+        return images
+
+    def _resolve(self, images, key):
+        """Locates the image referenced by a tag.
+
+        :param dict images: The images as returned by :meth:`_load_images`.
+
+        :param tuple key: The key returned by :meth:`_read_tags`.
+
+        :return: the image, or ``None`` if it does not exist
+        """
+        table_name, r_id = key
+        return images[table_name].get(r_id)
+
+    def _find_untagged(self, tags, images):
+        """Lists the images not referenced by any tag.
+
+        :param tags: The tags as returned by :meth:`_read_tags`.
+
+        :param dict images: The images as returned by :meth:`_load_images`.
+
+        :return: the images, ordered by table and row ID, or an empty tuple
+            if images without tags are not loaded
+        :rtype: tuple
+        """
+        if not self._include_untagged:
+            return ()
+
+        referenced = set(key for _, keys in tags for key in keys)
+        return tuple(
+            image
+            for table_name in sorted(images)
+            for r_id, image in sorted(images[table_name].items())
+            if (table_name, r_id) not in referenced)
+
+    def _placement(self, tags, images):
+        """Calculates which images each tag should contain directly.
+
+        An image referenced by a tag is only put in the tag if no descendant
+        tag references it as well.
+
+        :param tags: The tags as returned by :meth:`_read_tags`.
+
+        :param dict images: The images as returned by :meth:`_load_images`.
+
+        :return: a mapping from absolute tag path to the list of images
+        :rtype: dict
+        """
+        placement = {}
+        for path, keys in tags:
+            tag_images = placement.setdefault(path, [])
+            for key in keys:
+                image = self._resolve(images, key)
+                if image is not None:
+                    tag_images.append(image)
+
+        # Collect the images referenced by descendants of every tag
+        claimed = {}
+        for path, tag_images in placement.items():
+            parent = path.rsplit(os.path.sep, 1)[0]
+            while parent:
+                claimed.setdefault(parent, set()).update(tag_images)
+                parent = parent.rsplit(os.path.sep, 1)[0]
+
+        return {
+            path: [
+                image
+                for image in tag_images
+                if image not in claimed.get(path, ())]
+            for path, tag_images in placement.items()}
+
+    def load_tags(self, root):
+        rows, tags = self._read()
+
+        images = self._load_images(rows)
+        placed = self._placement(tags, images)
+        self._update_tags(placed, root)
+
+        root.untagged = self._find_untagged(tags, images)
+        self._rows, self._images, self._tags, self._placed = \
+            rows, images, tags, placed
+
+    def get_state(self):
+        state = super(ShotwellSource, self).get_state()
+        state['shotwell'] = (
+            self._rows, self._images, self._tags, self._include_untagged)
+        return state
+
+    def set_state(self, state, root):
+        rows, images, tags, include_untagged = state['shotwell']
+        if include_untagged != self._include_untagged:
+            raise ValueError('The snapshot does not contain the same images')
+        super(ShotwellSource, self).set_state(state, root)
+        root.untagged = self._find_untagged(tags, images)
+        self._rows, self._images, self._tags, self._placed = \
+            rows, images, tags, self._placement(tags, images)
+
+    def update_tags(self, root):
+        rows, tags = self._read()
+
+        # The database may have been written without changing anything we use
+        if rows == self._rows and tags == self._tags:
+            return
+
+        images = self._load_images(rows, self._rows, self._images)
+        placed = self._placement(tags, images)
+        self._update_tags(placed, root, self._placed)
+        root.untagged = self._find_untagged(tags, images)
+
+        self._rows, self._images, self._tags, self._placed = \
+            rows, images, tags, placed